@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Long-run benchmark of the whole service on a plain Linux box.
+#
+#   python3 bench/bench_service.py --duration 24h --latency 20 --jitter 10 --failure-rate 0.01
+#
+# Starts bench/fake_shelly.py (unless --host is given), builds the meters of config.ini with the
+# stub VeDbusService of bench/stubs and runs their ticks back to back. The clock of the service
+# is simulated: every tick advances it by the interval the service asked for, so a day of
+# polling runs in minutes while the interval adaptation, the backoff and the energy tiers behave
+# as on the GX. Reports the time and CPU per tick, the D-Bus writes and signals, the requests,
+# the RSS and, with --tracemalloc, the Python allocations.
+
+import argparse
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import harness
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class SimulatedClock:
+    """Drop-in for the time module as seen by the service."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def duration(text):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated long run of the service against a fake Shelly')
+    parser.add_argument('--duration', default='1h', help='simulated time, e.g. 900s, 30m, 24h')
+    parser.add_argument('--host', help='use this Shelly (or stand-in) instead of starting bench/fake_shelly.py')
+    parser.add_argument('--meters', type=int, default=1, help='number of meters, all served by the same stand-in')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in answer delay, ms')
+    parser.add_argument('--jitter', type=float, default=0, help='stand-in answer jitter, ms')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of failed stand-in answers')
+    parser.add_argument('--payloads', help='JSON file of recorded answers for the stand-in')
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.Key=value',
+                        help='override a config.ini value, e.g. SHELLY_CONNECTION.EnergyInterval=0')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace the Python allocations (slower)')
+    args = parser.parse_args()
+
+    server = None
+    host = args.host
+    if host is None:
+        port = free_port()
+        command = [sys.executable, os.path.join(BENCH_DIR, 'fake_shelly.py'), '--port', str(port),
+                   '--latency', str(args.latency), '--jitter', str(args.jitter), '--failure-rate', str(args.failure_rate)]
+        if args.payloads:
+            command += ['--payloads', args.payloads]
+        server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+        host = '127.0.0.1:%d' % port
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    try:
+        overrides = {'SHELLY_CONNECTION': {'Host': host, 'PollMode': 'blocking', 'Ingest': 'poll'}}
+        for index in range(1, args.meters):
+            overrides['SHELLY_CONNECTION:bench%d' % index] = {'Host': host, 'PollMode': 'blocking'}
+            overrides['PVINVERTER:bench%d' % index] = {'Phase': 'B', 'Deviceinstance': str(100 + index)}
+        for item in args.set:
+            key, value = item.split('=', 1)
+            section, key = key.rsplit('.', 1)
+            overrides.setdefault(section, {})[key] = value
+        config = harness.load_config(**overrides)
+
+        driver = harness.load_driver()
+        clock = SimulatedClock()
+        driver.time = clock
+        glib = driver.gobject
+
+        names = [''] + ['bench%d' % index for index in range(1, args.meters)]
+        paths = harness.paths()
+        meters = [driver.ShellyPro3EM(config, paths={'PVINVERTER': paths, 'GRID': paths, 'GENSET': paths}, name=name)
+                  for name in names]
+        # next simulated time each meter is due
+        due = {meter: clock.now for meter in meters}
+
+        end = clock.now + duration(args.duration)
+        rss_start = rss_kb()
+        if args.tracemalloc:
+            tracemalloc.start()
+        tick_times = []
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        while True:
+            meter = min(due, key=due.get)
+            if due[meter] >= end:
+                break
+            clock.now = due[meter]
+            glib.timeouts.clear()
+            started = time.perf_counter()
+            meter._update()
+            tick_times.append(time.perf_counter() - started)
+            due[meter] = clock.now + glib.timeouts[-1] / 1000.0
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        ticks = len(tick_times)
+        roles = [role for meter in meters for role in meter.roles]
+        writes = sum(role._dbusservice.writes for role in roles)
+        signals = sum(role._dbusservice.signals for role in roles)
+        sent = sum(meter._rpc.stats()[0] for meter in meters)
+        opened = sum(meter._rpc.stats()[2] for meter in meters)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        print("simulated           %s, %d meter(s), %d roles" % (args.duration, len(meters), len(roles)))
+        print("ticks               %d in %.1f s wall" % (ticks, wall))
+        print("time per tick       mean %.3f ms  p50 %.3f  p95 %.3f  p99 %.3f  max %.3f" % (
+            statistics.mean(tick_times) * 1e3, percentile(tick_times, 0.5) * 1e3, percentile(tick_times, 0.95) * 1e3,
+            percentile(tick_times, 0.99) * 1e3, max(tick_times) * 1e3))
+        print("CPU per tick        %.3f ms (%.0f %% of wall)" % (cpu / ticks * 1e3, cpu / wall * 100))
+        print("HTTP requests       %d (%.2f per tick), %d connection(s) opened" % (sent, sent / ticks, opened))
+        print("D-Bus writes        %d (%.2f per tick), %d signals (%.2f per tick)" % (writes, writes / ticks, signals, signals / ticks))
+        print("RSS                 %d kB at start, %d kB at end, %d kB max" % (rss_start, rss_kb(), usage.ru_maxrss))
+        if args.tracemalloc:
+            print("Python allocations  %d kB held at end, %d kB peak" % (current // 1024, peak // 1024))
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Time from the launch of the service to the registration of its D-Bus services.
+#
+#   python3 bench/bench_startup.py --latency 3000
+#
+# Each run starts a fresh interpreter that imports the service with the stub vedbus and GLib of
+# bench/stubs and builds the meters of config.ini, against bench/fake_shelly.py (unless --host is
+# given: e.g. --host 10.255.255.1 for a meter that does not answer at all). The time is counted
+# from the launch of the interpreter to each register() call.
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def child(launched, host):
+    started = time.monotonic()
+    import harness
+    driver = harness.load_driver()
+    imported = time.monotonic()
+
+    registered = []
+    register = driver.VeDbusService.register
+
+    def timed_register(service):
+        registered.append((time.monotonic(), 'requests' in sys.modules and sys.modules['requests'] is not None))
+        register(service)
+    driver.VeDbusService.register = timed_register
+
+    config = harness.load_config(SHELLY_CONNECTION={'Host': host}, GRID={'Phase': 'A'})
+    paths = harness.paths()
+    driver.ShellyPro3EM(config, paths={'PVINVERTER': paths, 'GRID': paths, 'GENSET': paths})
+    print("%f %f %f %f %d" % (started - launched, imported - launched, registered[0][0] - launched,
+                              registered[-1][0] - launched, registered[0][1]))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch to D-Bus registration time of the service')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--host', help='use this Shelly (or address) instead of starting bench/fake_shelly.py')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in answer delay, ms')
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        return child(args.child, args.host)
+
+    server = None
+    host = args.host
+    if host is None:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_shelly.py'), '--port', str(port),
+                                   '--latency', str(args.latency)], stderr=subprocess.DEVNULL)
+        host = '127.0.0.1:%d' % port
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    try:
+        results = []
+        for _ in range(args.runs):
+            launched = time.monotonic()
+            output = subprocess.run([sys.executable, os.path.realpath(__file__), '--host', host, '--child', str(launched)],
+                                    cwd=BENCH_DIR, stdout=subprocess.PIPE, check=True).stdout.split()
+            results.append([float(value) for value in output])
+    finally:
+        if server is not None:
+            server.terminate()
+
+    labels = ('interpreter started', 'service imported', 'first service registered', 'last service registered')
+    for index, label in enumerate(labels):
+        print("%-26s %8.1f ms (median of %d)" % (label, statistics.median(run[index] for run in results) * 1000, len(results)))
+    print("%-26s %s" % ('requests imported by then', 'yes' if any(run[4] for run in results) else 'no'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Latency and CPU per reading of the transports, against bench/fake_shelly.py.
+#
+#   python3 bench/bench_transport.py --samples 2000
+#
+# Each transport reads power and energy (EnergyInterval = 0) through ShellyPro3EM._fetchSample:
+# 'http single' is one Shelly.GetStatus request, 'http two calls' is EM.GetStatus + EMData.GetStatus,
+# 'modbus' is two input register reads over Modbus TCP. The CPU is the one of this process only,
+# the stand-in runs in its own. 'udp' is pushed, it has no request: its row is the CPU spent
+# receiving and decoding one datagram of shelly/udp-push.js.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import harness
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+TRANSPORTS = (
+    ('http single', {'Transport': 'http', 'SingleRequest': '1'}),
+    ('http two calls', {'Transport': 'http', 'SingleRequest': '0'}),
+    ('modbus', {'Transport': 'modbus'}),
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and CPU per reading, HTTP RPC against Modbus TCP')
+    parser.add_argument('--samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    port, modbus_port = free_port(), free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_shelly.py'), '--port', str(port),
+                               '--modbus-port', str(modbus_port)], stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', modbus_port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        driver = harness.load_driver()
+        paths = harness.paths()
+        print("%-16s %12s %12s %12s" % ('transport', 'latency p50', 'latency p95', 'CPU/reading'))
+        for name, settings in TRANSPORTS:
+            connection = dict(settings, Host='127.0.0.1:%d' % port, ModbusPort=str(modbus_port),
+                              PollMode='blocking', EnergyInterval='0', History='0', PayloadBuffer='0')
+            config = harness.load_config(SHELLY_CONNECTION=connection)
+            meter = driver.ShellyPro3EM(config, paths={'PVINVERTER': paths, 'GRID': paths, 'GENSET': paths})
+            meter._fetchSample()  # connect
+            latencies = []
+            cpu_start = time.process_time()
+            for _ in range(args.samples):
+                started = time.perf_counter()
+                meter_data, energy_data = meter._fetchSample()
+                latencies.append(time.perf_counter() - started)
+                assert meter_data and energy_data
+            cpu = time.process_time() - cpu_start
+            latencies.sort()
+            print("%-16s %9.3f ms %9.3f ms %9.3f ms" % (
+                name, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.95)] * 1e3,
+                cpu / args.samples * 1e3))
+
+        udp_port = free_port()
+        config = harness.load_config(SHELLY_CONNECTION={'Host': '127.0.0.1:%d' % port, 'Ingest': 'udp', 'UdpPort': str(udp_port),
+                                                        'History': '0', 'PayloadBuffer': '0'})
+        meter = driver.ShellyPro3EM(config, paths={'PVINVERTER': paths, 'GRID': paths, 'GENSET': paths})
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        values = [230.1, 3.12, 717.6] * 3 + [123456.78, 2345.67] * 3
+        cpu = 0
+        for sequence in range(1, args.samples + 1):
+            line = 'shellypro3em-aabbccddeeff %d 1700000000.123 1|P3EM %s' % (sequence, json.dumps([1, sequence] + values))
+            sender.sendto(line.encode(), ('127.0.0.1', udp_port))
+            started = time.process_time()
+            datagram, _ = meter._udpSocket.recvfrom(2048)
+            assert meter._parseDatagram(datagram) is not None
+            cpu += time.process_time() - started
+        print("%-16s %12s %12s %9.3f ms" % ('udp', '-', '-', cpu / args.samples * 1e3))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
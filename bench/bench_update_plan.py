@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Microbenchmark of the per-tick publishing code of one role.
+#
+#   python3 bench/bench_update_plan.py --ticks 100000
+#
+# 'per-tick config' is the former _update body: it reads and validates the [PVINVERTER] section,
+# builds the Shelly keys with f-strings and writes every path on every tick. 'compiled plan' is
+# DbusShellyEMService.publishSample, which runs the plan built once by _compilePlan. Both get the
+# same readings and write to the stub VeDbusService of bench/stubs.
+
+import argparse
+import random
+import time
+
+import harness
+
+
+def readings(count):
+    samples = []
+    energy = 1000.0
+    for _ in range(count):
+        power = round(random.uniform(-2000, 2000), 1)
+        energy += abs(power) / 3600.0
+        meter_data = {}
+        energy_data = {}
+        for phase in 'abc':
+            meter_data['%s_voltage' % phase] = round(random.uniform(228, 232), 1)
+            meter_data['%s_current' % phase] = round(abs(power) / 230, 3)
+            meter_data['%s_act_power' % phase] = power
+            energy_data['%s_total_act_energy' % phase] = round(energy, 2)
+            energy_data['%s_total_act_ret_energy' % phase] = 500.0
+        samples.append((meter_data, energy_data))
+    return samples
+
+
+def per_tick_config(config, service, meter_data, energy_data):
+    source_phase = str(config['PVINVERTER']['Phase'])
+    valid_phases = {'A', 'B', 'C', 'OFF'}
+    if source_phase not in valid_phases:
+        raise ValueError(f"Phase value '{source_phase}' is not valid. Must be one of {valid_phases}.")
+    pvinverter_phase = str(config['PVINVERTER']['PhaseDestination'])
+    valid_Dbus_phases = {'L1', 'L2', 'L3'}
+    if pvinverter_phase not in valid_Dbus_phases:
+        raise ValueError(f"PhaseDestination value '{pvinverter_phase}' is not valid. Must be one of {valid_Dbus_phases}.")
+    invertpowersign = str(config['PVINVERTER']['InvertPowerSign'])
+    valid_invertpowersign = {'0', '1'}
+    if invertpowersign not in valid_invertpowersign:
+        raise ValueError(f"InvertPowerSign value '{invertpowersign}' is not valid. Must be one of {valid_invertpowersign}.")
+    energy_type = str(config['PVINVERTER'].get('EnergyType', 'direct')).lower()
+    valid_energy_types = {'direct', 'return'}
+    if energy_type not in valid_energy_types:
+        energy_type = 'direct'
+
+    for phase in ['L1', 'L2', 'L3']:
+        pre = '/Ac/' + phase
+        service['/StatusCode'] = 7
+        if phase == pvinverter_phase:
+            power = meter_data.get(f'{source_phase.lower()}_act_power')
+            voltage = meter_data.get(f'{source_phase.lower()}_voltage')
+            current = meter_data.get(f'{source_phase.lower()}_current')
+            if invertpowersign == '1':
+                power = -power
+                current = -current
+            service[pre + '/Voltage'] = voltage
+            service[pre + '/Current'] = current
+            service[pre + '/Power'] = power
+            service['/Ac/Power'] = power
+            if energy_type == 'direct':
+                energy_key = f"{source_phase.lower()}_total_act_energy"
+                energy_reverse_key = f"{source_phase.lower()}_total_act_ret_energy"
+            else:
+                energy_key = f"{source_phase.lower()}_total_act_ret_energy"
+                energy_reverse_key = f"{source_phase.lower()}_total_act_energy"
+            energy_value = energy_data.get(energy_key)
+            energy_reverse_value = energy_data.get(energy_reverse_key)
+            service[pre + '/Energy/Forward'] = energy_value / 1000
+            service['/Ac/Energy/Forward'] = energy_value / 1000
+            service[pre + '/Energy/Reverse'] = energy_reverse_value / 1000
+            service['/Ac/Energy/Reverse'] = energy_reverse_value / 1000
+        else:
+            service[pre + '/Voltage'] = None
+            service[pre + '/Current'] = None
+            service[pre + '/Power'] = None
+            service[pre + '/Energy/Forward'] = None
+            service[pre + '/Energy/Reverse'] = None
+    index = service['/UpdateIndex'] + 1
+    if index > 255:
+        index = 0
+    service['/UpdateIndex'] = index
+    service['/Mode'] = 0
+
+
+def run(name, tick, samples):
+    started = time.perf_counter()
+    for meter_data, energy_data in samples:
+        tick(meter_data, energy_data)
+    elapsed = time.perf_counter() - started
+    print("%-18s %8.2f us/tick" % (name, elapsed / len(samples) * 1e6))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time per tick of the per-role publishing code')
+    parser.add_argument('--ticks', type=int, default=50000)
+    args = parser.parse_args()
+
+    driver = harness.load_driver()
+    config = harness.load_config(PVINVERTER={'Phase': 'B', 'PhaseDestination': 'L1'})
+    samples = readings(args.ticks)
+
+    role = driver.DbusShellyEMService('PVINVERTER', 'com.victronenergy.pvinverter', harness.paths(),
+                                      config['PVINVERTER'], productid=41281)
+    legacy = driver.VeDbusService('legacy')
+    legacy.values['/UpdateIndex'] = 0
+
+    before = run('per-tick config', lambda m, e: per_tick_config(config, legacy, m, e), samples)
+    after = run('compiled plan', lambda m, e: role.publishSample(1, m, e), samples)
+    print("%-18s %8.1f %%" % ('time per tick', (after - before) / before * 100))
+
+
+if __name__ == '__main__':
+    main()
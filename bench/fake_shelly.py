@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Project: dbus-shelly-pro-3em-smartmeter
+# Source: https://github.com/f5uii/dbus-shelly-pro-3em-smartmeter
+#
+# Local stand-in for a Shelly Pro 3EM, to run the service without the hardware.
+# It answers the Gen2 RPC calls used by the service over HTTP (/rpc/<Method>)
+# and over the WebSocket channel (ws://<host>/rpc), where it pushes
+# NotifyStatus frames in the Shelly format.
+#
+#   python3 bench/fake_shelly.py --port 8080 --notify-interval 0.5
+#
+# then set Host=127.0.0.1:8080 in config.ini.
+#
+# --latency/--jitter delay the HTTP answers, --failure-rate makes a share of them
+# fail (HTTP 500 or dropped connection), --payloads serves recorded answers from a
+# JSON file {"EM.GetStatus": {...}, "EMData.GetStatus": {...}, "Sys.GetConfig": {...}}.
+# --password asks for digest authentication (SHA-256, user admin) like the device.
+#
+# --modbus-port also serves the EM and EMData values as Modbus TCP input registers,
+# like the device with Modbus enabled. --udp-target sends the datagrams of
+# shelly/udp-push.js, as the UDP debug log of the device carries them.
+# ─────────────────────────────────────────────────────────────────────────────
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEVICE_ID = 'shellypro3em-aabbccddeeff'
+
+# Modbus input registers, by the RPC method they mirror: (first register, count, {key: (offset of its float32, scale)}),
+# scale from the unit of the RPC answer to the one of the register table of the device (energy in kWh)
+MODBUS_REGISTERS = {
+    'EM.GetStatus': (31020, 50, dict(
+        ('%s_%s' % (phase, name), (20 * index + offset, 1)) for index, phase in enumerate('abc')
+        for name, offset in (('voltage', 0), ('current', 2), ('act_power', 4), ('aprt_power', 6), ('pf', 8)))),
+    'EMData.GetStatus': (31170, 46, dict(
+        ('%s_%s' % (phase, name), (20 * index + offset, 0.001)) for index, phase in enumerate('abc')
+        for name, offset in (('total_act_energy', 0), ('total_act_ret_energy', 4)))),
+}
+
+
+class FakePro3EM:
+    """Synthetic meter: slowly drifting power on the three phases, energy integrated from it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._last = self._started
+        self.energy = {phase: [1000.0, 500.0] for phase in 'abc'}  # Wh [consumed, returned]
+        self.recorded = {}
+
+    def _power(self, phase, now):
+        offset = {'a': 0, 'b': 2, 'c': 4}[phase]
+        return 800 * math.sin((now - self._started) / 60.0 + offset) + random.uniform(-5, 5)
+
+    def em(self):
+        now = time.time()
+        with self._lock:
+            data = {'id': 0}
+            total = 0
+            for phase in 'abc':
+                power = round(self._power(phase, now), 1)
+                voltage = round(230 + random.uniform(-2, 2), 1)
+                data['%s_voltage' % phase] = voltage
+                data['%s_current' % phase] = round(abs(power) / voltage, 3)
+                data['%s_act_power' % phase] = power
+                data['%s_aprt_power' % phase] = abs(power)
+                data['%s_pf' % phase] = 1
+                data['%s_freq' % phase] = 50
+                total += power
+                # integrate since the previous call
+                energy = power * (now - self._last) / 3600.0
+                self.energy[phase][0 if energy > 0 else 1] += abs(energy)
+            data['total_act_power'] = round(total, 1)
+            self._last = now
+        return data
+
+    def emdata(self):
+        with self._lock:
+            data = {'id': 0}
+            for phase in 'abc':
+                data['%s_total_act_energy' % phase] = round(self.energy[phase][0], 2)
+                data['%s_total_act_ret_energy' % phase] = round(self.energy[phase][1], 2)
+            data['total_act'] = round(sum(e[0] for e in self.energy.values()), 2)
+            data['total_act_ret'] = round(sum(e[1] for e in self.energy.values()), 2)
+        return data
+
+    def rpc(self, method):
+        if method in self.recorded:
+            return self.recorded[method]
+        if method == 'Shelly.GetStatus' and 'EM.GetStatus' in self.recorded:
+            return {'em:0': self.rpc('EM.GetStatus'), 'emdata:0': self.rpc('EMData.GetStatus')}
+        if method == 'EM.GetStatus':
+            return self.em()
+        if method == 'EMData.GetStatus':
+            return self.emdata()
+        if method == 'Shelly.GetStatus':
+            return {'em:0': self.em(), 'emdata:0': self.emdata(), 'sys': {'uptime': int(time.time() - self._started)}}
+        if method == 'Sys.GetConfig':
+            return {'device': {'name': None, 'mac': 'AABBCCDDEEFF', 'fw_id': '20250101-000000/1.4.4-gfake', 'discoverable': True}}
+        return None
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ShellyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body go out in two writes
+    # set on the subclass made by serve()
+    meter = None
+    args = None
+    nonce = None       # nonce of the HTTP digest challenges, valid for the life of the server
+    challenges = 0     # 401 answers sent over HTTP
+    websockets = None  # sockets of the open WebSocket channels, a test can shut them down
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/rpc' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            return self._websocket()
+        if not path.startswith('/rpc/'):
+            return self._reply(404, b'')
+
+        delay = self.args.latency + random.uniform(-self.args.jitter, self.args.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if random.random() < self.args.failure_rate:
+            if random.random() < 0.5:
+                return self._reply(500, b'{"code":-1,"message":"simulated failure"}')
+            # dropped connection, as when the Shelly reboots
+            self.close_connection = True
+            return
+        if self.args.password and not self._digestAuthorized():
+            type(self).challenges += 1
+            challenge = 'Digest qop="auth", realm="%s", nonce="%s", algorithm=SHA-256' % (DEVICE_ID, self.nonce)
+            return self._reply(401, b'{"code":401,"message":"unauthorized"}', {'WWW-Authenticate': challenge})
+        result = self.meter.rpc(path[5:])
+        if result is None:
+            return self._reply(404, b'{"code":404,"message":"No handler for %s"}' % path[5:].encode())
+        self._reply(200, json.dumps(result).encode())
+
+    def _reply(self, code, body, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _digestAuthorized(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Digest '):
+            return False
+        fields = dict(re.findall(r'(\w+)="?([^",]*)"?', header[7:]))
+        if fields.get('nonce') != str(self.nonce) or fields.get('uri') != self.path:
+            return False
+        ha1 = sha256('admin:%s:%s' % (DEVICE_ID, self.args.password))
+        ha2 = sha256('GET:%s' % fields['uri'])
+        expected = sha256(':'.join((ha1, fields['nonce'], fields.get('nc', ''), fields.get('cnonce', ''), fields.get('qop', ''), ha2)))
+        return fields.get('response') == expected
+
+    # --- WebSocket RPC channel ---
+
+    def _websocket(self):
+        accept = base64.b64encode(hashlib.sha1(
+            (self.headers['Sec-WebSocket-Key'] + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        self.websockets.add(self.connection)
+        self._sendLock = threading.Lock()
+        self._peer = None
+        self._nonce = int(time.time())
+        stop = threading.Event()
+        notifier = threading.Thread(target=self._notifyLoop, args=(stop,))
+        notifier.daemon = True
+        notifier.start()
+        try:
+            while True:
+                opcode, payload = self._readFrame()
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self._sendFrame(0xA, payload)
+                elif opcode == 0x1:
+                    self._handleRequest(json.loads(payload.decode()))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            stop.set()
+            self.websockets.discard(self.connection)
+
+    def _handleRequest(self, request):
+        frame = {'id': request.get('id'), 'src': DEVICE_ID, 'dst': request.get('src')}
+        if self.args.password and not self._authorized(request.get('auth')):
+            challenge = {'auth_type': 'digest', 'nonce': self._nonce, 'nc': 1, 'realm': DEVICE_ID, 'algorithm': 'SHA-256'}
+            frame['error'] = {'code': 401, 'message': json.dumps(challenge)}
+        else:
+            result = self.meter.rpc(request.get('method'))
+            if result is None:
+                frame['error'] = {'code': 404, 'message': 'No handler for %s' % request.get('method')}
+            else:
+                frame['result'] = result
+                # like the device, notifications go to the src of the last request
+                self._peer = request.get('src')
+        self._sendJson(frame)
+
+    def _authorized(self, auth):
+        if not auth:
+            return False
+        ha1 = sha256('admin:%s:%s' % (DEVICE_ID, self.args.password))
+        ha2 = sha256('dummy_method:dummy_uri')
+        expected = sha256('%s:%s:1:%s:auth:%s' % (ha1, self._nonce, auth.get('cnonce'), ha2))
+        return auth.get('nonce') == self._nonce and auth.get('response') == expected
+
+    def _notifyLoop(self, stop):
+        count = 0
+        while not stop.wait(self.args.notify_interval):
+            if self._peer is None:
+                continue
+            params = {'ts': round(time.time(), 2), 'em:0': self.meter.em()}
+            count += 1
+            if count % self.args.energy_every == 0:
+                params['emdata:0'] = self.meter.emdata()
+            try:
+                self._sendJson({'src': DEVICE_ID, 'dst': self._peer, 'method': 'NotifyStatus', 'params': params})
+            except OSError:
+                return
+
+    def _sendJson(self, frame):
+        self._sendFrame(0x1, json.dumps(frame).encode())
+
+    def _sendFrame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._sendLock:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def _readFrame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            raise ConnectionError('closed')
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return head[0] & 0x0F, payload
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    """'Read input registers' (function 4) over Modbus TCP, one block of MODBUS_REGISTERS per request."""
+    meter = None
+    args = None
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            request = self._recv(12)
+            if request is None:
+                return
+            transaction, _, _, unit, function, first, count = struct.unpack('>HHHBBHH', request)
+            delay = self.args.latency + random.uniform(-self.args.jitter, self.args.jitter)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            if random.random() < self.args.failure_rate:
+                return
+            registers = self._registers(first, count) if function == 4 else None
+            if registers is None:
+                # exception 2: illegal data address (1: illegal function)
+                code = 2 if function == 4 else 1
+                self.request.sendall(struct.pack('>HHHBBB', transaction, 0, 3, unit, function | 0x80, code))
+                continue
+            self.request.sendall(struct.pack('>HHHBBB', transaction, 0, 3 + len(registers), unit, 4, len(registers)) + registers)
+
+    def _registers(self, first, count):
+        for method, (start, size, fields) in MODBUS_REGISTERS.items():
+            if start <= first and first + count <= start + size:
+                data = self.meter.rpc(method)
+                block = bytearray(size * 2)
+                for key, (offset, scale) in fields.items():
+                    value = struct.pack('>f', (data.get(key) or 0) * scale)
+                    # low word first, like the device
+                    block[offset * 2:offset * 2 + 4] = value[2:] + value[:2]
+                return bytes(block[(first - start) * 2:(first - start + count) * 2])
+        return None
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+def udp_loop(meter, args):
+    # one datagram per --notify-interval, in the format of the debug log lines of the device
+    host, _, port = args.udp_target.partition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    session = int(time.time())
+    sequence = 0
+    while True:
+        time.sleep(args.notify_interval)
+        sequence = (sequence + 1) % 65536
+        if random.random() < args.udp_loss:
+            continue
+        em, emdata = meter.rpc('EM.GetStatus'), meter.rpc('EMData.GetStatus')
+        values = [session, sequence]
+        for phase in 'abc':
+            values += [em['%s_voltage' % phase], em['%s_current' % phase], em['%s_act_power' % phase]]
+        for phase in 'abc':
+            values += [emdata['%s_total_act_energy' % phase], emdata['%s_total_act_ret_energy' % phase]]
+        line = '%s %d %.3f 1|P3EM %s' % (DEVICE_ID, sequence, time.time(), json.dumps(values, separators=(',', ':')))
+        sock.sendto(line.encode(), (host, int(port)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local Shelly Pro 3EM stand-in (HTTP RPC and WebSocket)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--password', default='', help='require digest authentication, over HTTP and on the WebSocket channel')
+    parser.add_argument('--notify-interval', type=float, default=1.0, help='seconds between two NotifyStatus frames')
+    parser.add_argument('--energy-every', type=int, default=10, help='add emdata:0 to every Nth notification')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds before each HTTP answer')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- milliseconds added to --latency')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of the HTTP requests that fail, 0 to 1')
+    parser.add_argument('--payloads', help='JSON file of recorded answers, by RPC method')
+    parser.add_argument('--modbus-port', type=int, help='also serve the EM and EMData registers over Modbus TCP on this port')
+    parser.add_argument('--udp-target', metavar='HOST:PORT', help='send the datagrams of shelly/udp-push.js there, every --notify-interval')
+    parser.add_argument('--udp-loss', type=float, default=0, help='share of the datagrams not sent, 0 to 1')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args(argv)
+
+
+def serve(args):
+    """Start the Modbus and UDP parts of the stand-in in background threads and return its HTTP server,
+    not serving yet. Each call gets its own meter, so several stand-ins can run in one process."""
+    meter = FakePro3EM()
+    if args.payloads:
+        with open(args.payloads) as payloads:
+            meter.recorded = json.load(payloads)
+    handler = type('ShellyHandler', (ShellyHandler,), {'meter': meter, 'args': args, 'nonce': int(time.time()), 'websockets': set()})
+    if args.modbus_port:
+        modbus_handler = type('ModbusHandler', (ModbusHandler,), {'meter': meter, 'args': args})
+        modbus = socketserver.ThreadingTCPServer((args.host, args.modbus_port), modbus_handler)
+        modbus.daemon_threads = True
+        threading.Thread(target=modbus.serve_forever, daemon=True).start()
+        logging.info("Modbus TCP on %s:%d", args.host, args.modbus_port)
+    if args.udp_target:
+        threading.Thread(target=udp_loop, args=(meter, args), daemon=True).start()
+        logging.info("Sending datagrams to %s", args.udp_target)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    server = serve(args)
+    logging.info("Fake Shelly Pro 3EM listening on %s:%d (pid %d)", args.host, server.server_address[1], os.getpid())
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Helpers shared by the benchmarks: load the service with the stubs in place of vedbus and GLib.
+
+import configparser
+import importlib.util
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+DRIVER = os.path.join(os.path.dirname(BENCH_DIR), 'dbus-shelly-pro-3em-pvinverter.py')
+
+
+def load_driver():
+    sys.path.insert(0, os.path.join(BENCH_DIR, 'stubs'))
+    spec = importlib.util.spec_from_file_location('dbus_shelly_pro_3em', DRIVER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_config(**overrides):
+    """config.ini of the repository, with {'SECTION': {'Key': 'value'}} overrides."""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(BENCH_DIR), 'config.ini'))
+    for section, values in overrides.items():
+        if section != 'DEFAULT' and not config.has_section(section):
+            config.add_section(section)
+        for key, value in values.items():
+            config[section][key] = value
+    return config
+
+
+def paths():
+    """The D-Bus paths main() registers for a role."""
+    paths = {'/Ac/Energy/Forward': None, '/Ac/Energy/Reverse': None, '/Ac/Power': 0, '/Ac/Current': 0, '/Ac/Voltage': 0}
+    for phase in ('L1', 'L2', 'L3'):
+        for name in ('Voltage', 'Current', 'Power', 'Energy/Forward', 'Energy/Reverse'):
+            paths['/Ac/%s/%s' % (phase, name)] = None
+    return {path: {'initial': initial, 'textformat': None} for path, initial in paths.items()}
@@ -0,0 +1,33 @@
+# Stand-in for dbus-python: a connection only tracks its object paths, and refuses to export one twice
+# like the real one does.
+
+
+class Connection:
+    def __init__(self):
+        self.paths = set()
+
+    def register_object_path(self, path):
+        if path in self.paths:
+            raise KeyError("Can't register the object-path handler for '%s': there is already a handler" % path)
+        self.paths.add(path)
+
+    def unregister_object_path(self, path):
+        self.paths.discard(path)
+
+    def close(self):
+        self.paths.clear()
+
+
+_shared = {}
+
+
+def SystemBus(private=False):
+    if private:
+        return Connection()
+    return _shared.setdefault('system', Connection())
+
+
+def SessionBus(private=False):
+    if private:
+        return Connection()
+    return _shared.setdefault('session', Connection())
@@ -0,0 +1,37 @@
+# Stand-in for PyGObject: the benchmarks drive the ticks themselves, the main loop never runs.
+
+
+class _GLib:
+    PRIORITY_DEFAULT = 0
+    IO_IN = 1
+
+    class Error(Exception):
+        pass
+
+    def __init__(self):
+        self.timeouts = []  # intervals (ms) of the timers armed since the last clear()
+        self.watches = []   # (fd, callback) of io_add_watch
+
+    def idle_add(self, function, *args):
+        return 0
+
+    def timeout_add(self, interval, function, *args):
+        self.timeouts.append(interval)
+        return 0
+
+    def timeout_add_seconds(self, interval, function, *args):
+        return 0
+
+    def io_add_watch(self, fd, priority, condition, function, *args):
+        self.watches.append((fd, function))
+        return 0
+
+    def source_remove(self, source):
+        return True
+
+    class MainLoop:
+        def run(self):
+            pass
+
+
+GLib = _GLib()
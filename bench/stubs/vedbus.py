@@ -0,0 +1,65 @@
+# Stand-in for velib_python's vedbus, to run the service without a D-Bus.
+# Keeps the values in a dict and counts what the real service would put on the bus.
+
+import os
+
+import dbus
+
+
+class VeDbusService:
+    def __init__(self, servicename, bus=None, register=True):
+        # like velib: the shared connection unless one is given, the root path is exported at once
+        self._bus = bus or (dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus())
+        self._exported = []
+        self._export('/')
+        self.servicename = servicename
+        self.values = {}
+        self.writes = 0     # assignments that changed a value
+        self.signals = 0    # PropertiesChanged / ItemsChanged signals emitted
+        self.registered = register
+        self._batch = None
+
+    def add_path(self, path, value, description="", writeable=False,
+                 onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None):
+        self._export(path)
+        self.values[path] = value
+
+    def _export(self, path):
+        self._bus.register_object_path(path)
+        self._exported.append(path)
+
+    def register(self):
+        self.registered = True
+
+    # velib: an explicit __del__() releases the bus name
+    def __del__(self):
+        for path in getattr(self, '_exported', ()):
+            self._bus.unregister_object_path(path)
+        self._exported = []
+        self.registered = False
+
+    def __getitem__(self, path):
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        if self.values.get(path) == value:
+            return
+        self.values[path] = value
+        self.writes += 1
+        if self._batch is None:
+            self.signals += 1
+        else:
+            self._batch += 1
+
+    def __delitem__(self, path):
+        del self.values[path]
+
+    # 'with service as s' batches the changes in one ItemsChanged signal, like recent velib
+    def __enter__(self):
+        self._batch = 0
+        return self
+
+    def __exit__(self, *exc):
+        if self._batch:
+            self.signals += 1
+        self._batch = None
@@ -25,327 +25,1881 @@ else:
     from gi.repository import GLib as gobject
 import sys
 import time
-import requests  # for http GET
+import random
+import threading
+import heapq
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import socket
+import struct
+import base64
+import hashlib
+import json
+import re
+import types
+import signal
+import mmap
 import configparser  # for config/ini file
+requests = None  # for http GET, imported with the first request (see ShellyRpcClient._openSession)
 
 
 # our own packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
+import dbus
+
+
+# seconds before reconnecting a dropped WebSocket, polling covers the gap
+WEBSOCKET_RECONNECT_DELAY = 10
+# longest pause between two requests to an unreachable meter, in seconds
+POLL_MAX_BACKOFF = 60
+# seconds to wait for the TCP port of a meter that is backing off
+POLL_PROBE_TIMEOUT = 0.5
+# seconds without a UDP datagram before polling takes over
+UDP_SILENCE_TIMEOUT = 5
+# marker of the lines printed by shelly/udp-push.js, followed by a JSON array: session, sequence number, UDP_FIELDS
+UDP_MARKER = 'P3EM '
+# values of a datagram after its session and sequence number: 9 for EM.GetStatus, then 6 for EMData.GetStatus
+UDP_FIELDS = tuple('%s_%s' % (phase, name) for phase in 'abc' for name in ('voltage', 'current', 'act_power')) + \
+    tuple('%s_%s' % (phase, name) for phase in 'abc' for name in ('total_act_energy', 'total_act_ret_energy'))
+# threads shared by all the meters for their HTTP requests
+POLL_WORKERS = 4
+# samples kept for the rolling round trip and tick latency percentiles
+STATS_WINDOW = 300
+# seconds between two updates of the /Diagnostics paths and /Latency
+STATS_PUBLISH_INTERVAL = 10
+# identity of the meters (Sys.GetConfig 'device') seen by the last run, by host
+DEVICE_CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'device_cache.json')
+# seconds between two Sys.GetConfig attempts while a meter does not answer
+DEVICE_RETRY_INTERVAL = 30
+# readings kept in the history of each meter, for the three phases
+HISTORY_KEYS = tuple('%s_%s' % (phase, name) for phase in 'abc' for name in ('voltage', 'current', 'act_power'))
+# raw readings kept for the smoothing
+HISTORY_RAW_SIZE = 256
+# aggregate levels of the history, (seconds per bucket, buckets): 10 min of 1 s, 4 h of 1 min, 7 days of 15 min
+HISTORY_LEVELS = ((1, 600), (60, 240), (900, 672))
+# windows published under /History/<Power|Voltage|Current>/<name>/<Min|Max|Mean>
+HISTORY_WINDOWS = (('1m', 60), ('15m', 900), ('24h', 86400))
+# last answers of a meter, written on error or on SIGUSR1 (%s: host)
+PAYLOAD_DUMP_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'payloads_%s.log')
+# ms config.ini has to stay unchanged before it is read again, editors write it in several steps
+CONFIG_SETTLE_DELAY = 500
+# seconds between two checks of config.ini where it cannot be watched with Gio
+CONFIG_POLL_INTERVAL = 2
+# keys of [SHELLY_CONNECTION] that are only read at startup, a change is logged but needs a restart
+CONFIG_RESTART_KEYS = ('Host', 'Username', 'Password', 'Transport', 'ModbusPort', 'ModbusUnit', 'Timeout', 'PollMode',
+                       'SingleRequest', 'Ingest', 'UdpPort', 'History', 'HistoryFile', 'PayloadBuffer', 'SummaryInterval',
+                       'Log_RepeatWindow')
+
+
+class RepeatFilter(logging.Filter):
+    """Lets the first of identical log records through and only counts the ones that follow within
+    window seconds. The number of occurrences in the window is appended to the next occurrence after
+    it, or logged by flush() when the message has stopped: "... (same message x120 in 60 s)".
+
+    Records are identical when they come from the same line with the same text once the object
+    addresses are left out: urllib3 puts "<... object at 0x7f...>" in every connection error."""
+
+    _ADDRESS = re.compile(r'0x[0-9a-fA-F]+')
+
+    def __init__(self, window):
+        super().__init__()
+        self._window = window
+        self._lock = threading.Lock()
+        self._seen = {}  # key -> [start of the window, repeats, message]
+
+    def filter(self, record):
+        now = time.monotonic()
+        message = record.getMessage()
+        key = (record.levelno, record.pathname, record.lineno, self._ADDRESS.sub('0x', message))
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self._window:
+                seen[1] += 1
+                return False
+            self._seen[key] = [now, 0, message]
+        if seen is not None and seen[1]:
+            record.msg, record.args = "%s (same message x%d in %.0f s)", (message, seen[1] + 1, now - seen[0])
+        return True
 
+    def flush(self):
+        """Log the count of the messages that stopped repeating, forget the old ones. Called from a timer."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [(key, seen) for key, seen in self._seen.items() if now - seen[0] >= self._window]
+            for key, _ in expired:
+                del self._seen[key]
+        for key, (started, repeats, message) in expired:
+            if repeats:
+                logging.log(key[0], "%s (same message x%d in %.0f s)", message, repeats + 1, now - started)
+        return True
 
-class DbusShellyEMService:
-    def __init__(self, servicename, paths, productname='Shelly Pro3EM', connection='Shelly EM RPC JSON service'):
-        # Read the configuration only once at startup
-        self.config = self._getConfig()
-        deviceinstance = int(self.config['DEFAULT']['Deviceinstance'])
-        customname = self.config['DEFAULT']['CustomName']
 
-        self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance), register=False)
-        self._paths = paths
+class SampleHistory:
+    """Fixed-size time series of the voltage, current and power of the three phases.
+
+    Everything lives in one preallocated array of doubles: a ring of the raw readings and, for each
+    level of HISTORY_LEVELS, a ring of buckets holding the count and the min, max and sum of every
+    key. Given a file, the array is memory-mapped on it and a restart resumes the history of the
+    previous run. Only used from the main loop.
+    """
+
+    _MAGIC = 0x5333454D
+    _HEADER = 16  # magic, layout (8 values), then head and count of the raw ring and of each level
+
+    def __init__(self, path=None):
+        self._rawWidth = 1 + len(HISTORY_KEYS)           # time, values
+        self._bucketWidth = 2 + 3 * len(HISTORY_KEYS)    # start, count, (min, max, sum) per key
+        self._rawOffset = self._HEADER
+        self._levelOffsets = []
+        size = self._rawOffset + HISTORY_RAW_SIZE * self._rawWidth
+        for _, buckets in HISTORY_LEVELS:
+            self._levelOffsets.append(size)
+            size += buckets * self._bucketWidth
+
+        self._file = None
+        if path:
+            self._file = open(path, 'a+b')
+            if os.fstat(self._file.fileno()).st_size != size * 8:
+                self._file.truncate(0)
+                self._file.truncate(size * 8)
+            buffer = mmap.mmap(self._file.fileno(), size * 8)
+        else:
+            buffer = bytearray(size * 8)
+        self._data = memoryview(buffer).cast('d')
+
+        layout = [self._MAGIC, HISTORY_RAW_SIZE] + [buckets for _, buckets in HISTORY_LEVELS] + \
+            [period for period, _ in HISTORY_LEVELS]
+        if list(self._data[:len(layout)]) != layout:
+            # new file, or written with other sizes: start from scratch
+            self._data[:] = memoryview(bytes(size * 8)).cast('d')
+            for index, value in enumerate(layout):
+                self._data[index] = value
+            for ring in range(1 + len(HISTORY_LEVELS)):
+                self._data[8 + 2 * ring] = -1  # head, the next write goes to slot 0
+
+    def add(self, now, meter_data):
+        data = self._data
+        values = [meter_data.get(key) for key in HISTORY_KEYS]
+        head = (int(data[8]) + 1) % HISTORY_RAW_SIZE
+        base = self._rawOffset + head * self._rawWidth
+        data[base] = now
+        for index, value in enumerate(values, base + 1):
+            data[index] = float('nan') if value is None else value
+        data[8] = head
+        data[9] = min(data[9] + 1, HISTORY_RAW_SIZE)
+        if None in values:
+            # incomplete reading: kept raw, left out of the aggregates
+            return
+
+        for level, (period, buckets) in enumerate(HISTORY_LEVELS):
+            start = now - now % period
+            head = int(data[10 + 2 * level])
+            base = self._levelOffsets[level] + head * self._bucketWidth
+            if head >= 0 and data[base] == start:
+                data[base + 1] += 1
+                for index, value in enumerate(values):
+                    slot = base + 2 + 3 * index
+                    if value < data[slot]:
+                        data[slot] = value
+                    if value > data[slot + 1]:
+                        data[slot + 1] = value
+                    data[slot + 2] += value
+                continue
+            head = (head + 1) % buckets
+            base = self._levelOffsets[level] + head * self._bucketWidth
+            data[base] = start
+            data[base + 1] = 1
+            for index, value in enumerate(values):
+                slot = base + 2 + 3 * index
+                data[slot] = data[slot + 1] = data[slot + 2] = value
+            data[10 + 2 * level] = head
+            data[11 + 2 * level] = min(data[11 + 2 * level] + 1, buckets)
+
+    def smoothed(self, meter_data, seconds, now):
+        """Copy of meter_data with each history key replaced by its mean over the last seconds."""
+        data = self._data
+        sums = [0.0] * len(HISTORY_KEYS)
+        counts = [0] * len(HISTORY_KEYS)
+        head = int(data[8])
+        for age in range(int(data[9])):
+            base = self._rawOffset + (head - age) % HISTORY_RAW_SIZE * self._rawWidth
+            if data[base] < now - seconds:
+                break
+            for index in range(len(HISTORY_KEYS)):
+                value = data[base + 1 + index]
+                if value == value:  # not NaN
+                    sums[index] += value
+                    counts[index] += 1
+        smoothed = dict(meter_data)
+        for index, key in enumerate(HISTORY_KEYS):
+            if counts[index]:
+                smoothed[key] = sums[index] / counts[index]
+        return smoothed
+
+    def window(self, key, seconds, now):
+        """(min, max, mean) of key over the last seconds, from the finest level that covers them, or None."""
+        index = HISTORY_KEYS.index(key)
+        for level, (period, buckets) in enumerate(HISTORY_LEVELS):
+            if period * buckets >= seconds:
+                break
+        data = self._data
+        head = int(data[10 + 2 * level])
+        low = high = None
+        total = 0.0
+        count = 0
+        for age in range(int(data[11 + 2 * level])):
+            base = self._levelOffsets[level] + (head - age) % buckets * self._bucketWidth
+            if data[base] <= now - seconds:
+                break
+            slot = base + 2 + 3 * index
+            low = data[slot] if low is None else min(low, data[slot])
+            high = data[slot + 1] if high is None else max(high, data[slot + 1])
+            total += data[slot + 2]
+            count += data[base + 1]
+        if not count:
+            return None
+        return low, high, total / count
 
-        logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
-        paths_wo_unit = [
-            '/Status',
-            '/Mode'
-        ]
 
-        # Create the management objects, as specified in the ccgx dbus-api document
-        self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
-        self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
-        self._dbusservice.add_path('/Mgmt/Connection', connection)
+class PayloadRing:
+    """The last raw answers of a meter, kept in memory and only written to disk when asked."""
 
-        # Create the mandatory objects
-        self._dbusservice.add_path('/DeviceInstance', deviceinstance)
-        self._dbusservice.add_path('/ProductId', 41281 )  # id assigned by Victron Support from SDM630v2.py
-        self._dbusservice.add_path('/ProductName', productname)
-        self._dbusservice.add_path('/CustomName', customname, writeable=False)
-        self._dbusservice.add_path('/Connected', 1, writeable=True)
-        self._dbusservice.add_path('/Latency', None)
-        self._dbusservice.add_path('/FirmwareVersion', 0.1)
-        self._dbusservice.add_path('/Ac/MaxPower', 500.1, writeable=False, gettextcallback=lambda p, v: f"{v} W")
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._entries = collections.deque(maxlen=size)
 
+    def add(self, source, status, content):
+        with self._lock:
+            self._entries.append((time.time(), source, status, content))
 
+    def dump(self, path, reason):
+        with self._lock:
+            entries = list(self._entries)
+        try:
+            with open(path, 'w') as dump:
+                dump.write("# %s, %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), reason))
+                for timestamp, source, status, content in entries:
+                    dump.write("%s.%03d %s %s %s\n" % (
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), timestamp % 1 * 1000,
+                        source, '-' if status is None else status, content.decode('utf-8', 'replace')))
+        except OSError as e:
+            logging.warning("Cannot write %s: %s", path, e)
+            return
+        logging.warning("Last %d answers written to %s (%s)", len(entries), path, reason)
+
+
+class ShellyRpcClient:
+    """Gen2 RPC over HTTP with a single keep-alive connection to the device.
+
+    When a password is set the Shelly asks for digest authentication. The nonce of the last
+    challenge is reused for the following requests, so the 401 round trip is only paid again when
+    the device rejects it. After any error the connection is dropped and reopened on the next call.
+    """
+
+    def __init__(self, host, username='', password='', timeout=5, payloads=None):
+        self.host = host
+        self.payloads = payloads  # PayloadRing of the raw answers, or None
+        self._baseUrl = "http://%s/rpc/" % host
+        self._timeout = timeout
+        self._username = username
+        self._password = password
+        self._lock = threading.Lock()
+        self._session = None
+        self._auth = None
+        self.lastStatusCode = None
+        # counters of the sessions already closed
+        self._requests = 0
+        self._connections = 0
+
+    def get(self, method, **params):
+        with self._lock:
+            if self._session is None:
+                self._session = self._openSession()
+            self.lastStatusCode = None
+            try:
+                response = self._session.get(self._baseUrl + method, params=params, timeout=self._timeout)
+                self.lastStatusCode = response.status_code
+                if self.payloads is not None:
+                    self.payloads.add(method, response.status_code, response.content)
+                response.raise_for_status()
+                return response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if self.payloads is not None and self.lastStatusCode is None:
+                    self.payloads.add(method, None, str(e).encode())
+                self._closeSession()
+                raise
+
+    def reachable(self, timeout):
+        """Cheap check that the device accepts TCP connections, without any request."""
+        hostname, _, port = self.host.partition(':')
+        try:
+            socket.create_connection((hostname, int(port or 80)), timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        """Return (requests, requests on a reused connection, new connections)."""
+        with self._lock:
+            sent, opened = self._requests, self._connections
+            for pool in self._pools():
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return sent, sent - opened, opened
+
+    def close(self):
+        with self._lock:
+            self._closeSession()
+
+    def _openSession(self):
+        # requests is slow to import on a GX: it is loaded here, once the services are registered
+        global requests
+        import requests.adapters
+        import requests.auth
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        session.mount('http://', adapter)
+        if self._password:
+            # Gen2+ devices only know the 'admin' user
+            if self._auth is None:
+                self._auth = requests.auth.HTTPDigestAuth(self._username or 'admin', self._password)
+                # requests keeps the last challenge per thread, each PollScheduler worker would pay its own 401
+                # round trip: the calls are serialised by self._lock, so all the threads share one
+                self._auth._thread_local = types.SimpleNamespace()
+            session.auth = self._auth
+        return session
+
+    def _closeSession(self):
+        if self._session is None:
+            return
+        for pool in self._pools():
+            self._requests += pool.num_requests
+            self._connections += pool.num_connections
+        self._session.close()
+        self._session = None
+
+    def _pools(self):
+        if self._session is None:
+            return []
+        pools = self._session.get_adapter(self._baseUrl).poolmanager.pools
+        return [pools[key] for key in pools.keys()]
+
+
+# Modbus TCP input registers of the Pro 3EM (Modbus enabled in the Shelly settings), one block read per RPC
+# method they stand for: (first register, register count, {key: (offset of its float32, scale)}). From the
+# register tables of https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/EM#modbus-registers
+# (phase A from 31020, B from 31040, C from 31060: V, A, W, VA, PF) and
+# https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/EMData#modbus-registers (phase A from 31170,
+# B from 31190, C from 31210: total active energy at +0, total active returned energy at +4, both in kWh).
+# The scale turns them into the keys and units of EM.GetStatus and EMData.GetStatus (V, A, W, Wh).
+MODBUS_BLOCKS = {
+    'EM.GetStatus': (31020, 50, dict(
+        ('%s_%s' % (phase, name), (20 * index + offset, 1)) for index, phase in enumerate('abc')
+        for name, offset in (('voltage', 0), ('current', 2), ('act_power', 4), ('aprt_power', 6), ('pf', 8)))),
+    'EMData.GetStatus': (31170, 46, dict(
+        ('%s_%s' % (phase, name), (20 * index + offset, 1000)) for index, phase in enumerate('abc')
+        for name, offset in (('total_act_energy', 0), ('total_act_ret_energy', 4)))),
+}
+
+
+class ShellyModbusClient:
+    """Reads the EM and EMData registers of the Shelly over one persistent Modbus TCP connection.
+
+    get() answers 'EM.GetStatus' and 'EMData.GetStatus' with the same keys as the RPC calls, from a
+    single 'read input registers' request each. The connection is reopened after any error.
+    """
+
+    def __init__(self, host, port=502, unit=1, timeout=5, payloads=None):
+        self.host = host
+        self.payloads = payloads  # PayloadRing of the raw answers, or None
+        self._address = (host.partition(':')[0], port)
+        self._unit = unit
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._transaction = 0
+        self._requests = 0
+        self._connections = 0
+
+    def get(self, method, **params):
+        first, count, fields = MODBUS_BLOCKS[method]
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._sock = socket.create_connection(self._address, timeout=self._timeout)
+                    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._connections += 1
+                registers = self._readInputRegisters(first, count)
+            except (OSError, ValueError):
+                self._close()
+                raise
+        if self.payloads is not None:
+            self.payloads.add(method, None, registers.hex().encode())
+        # float32 with the low word first: swap the words of the block, then decode it in one call
+        swapped = bytearray(len(registers))
+        swapped[0::4], swapped[1::4], swapped[2::4], swapped[3::4] = \
+            registers[2::4], registers[3::4], registers[0::4], registers[1::4]
+        values = struct.unpack('>%df' % (count // 2), swapped)
+        data = {'id': 0}
+        for key, (offset, scale) in fields.items():
+            data[key] = round(values[offset // 2] * scale, 3)
+        return data
+
+    def reachable(self, timeout):
+        try:
+            socket.create_connection(self._address, timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        """Return (requests, requests on a reused connection, new connections)."""
+        return self._requests, self._requests - self._connections, self._connections
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _readInputRegisters(self, first, count):
+        self._transaction = (self._transaction + 1) % 65536
+        self._requests += 1
+        # MBAP header (transaction, protocol 0, length, unit) + function 4
+        self._sock.sendall(struct.pack('>HHHBBHH', self._transaction, 0, 6, self._unit, 4, first, count))
+        header = self._recv(9)
+        transaction, _, length, _, function, size = struct.unpack('>HHHBBB', header)
+        if transaction != self._transaction:
+            raise ValueError("Modbus answer %d to request %d" % (transaction, self._transaction))
+        if function & 0x80:
+            raise ConnectionError("Modbus exception %d reading %d registers at %d" % (size, count, first))
+        if size != count * 2 or length != size + 3:
+            raise ValueError("Modbus answer of %d bytes for %d registers" % (size, count))
+        return self._recv(size)
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Modbus connection to %s closed" % self.host)
+            data += chunk
+        return data
+
+
+class ShellyWebSocket:
+    """Minimal RFC 6455 client for the Gen2 RPC channel of the Shelly (ws://<host>/rpc).
+
+    Once a first request has been sent with our 'src', the device pushes NotifyStatus and
+    NotifyFullStatus frames to us on the same socket. Only text frames are used.
+    """
+
+    def __init__(self, host, username='', password='', timeout=10, payloads=None):
+        self.host = host
+        self.payloads = payloads  # PayloadRing of the received messages, or None
+        hostname, _, port = host.partition(':')
+        self._address = (hostname, int(port or 80))
+        self._username = username or 'admin'
+        self._password = password
+        self._timeout = timeout
+        self._sock = None
+        self._buffer = b''
+        self._message = b''  # text frames of a fragmented message received so far
+        self._nextId = 1
+        self._auth = None
+        self.src = 'dbus-shelly-%d' % os.getpid()
+
+    def connect(self):
+        self._sock = socket.create_connection(self._address, timeout=self._timeout)
+        self._buffer = b''
+        self._message = b''
+        key = base64.b64encode(os.urandom(16)).decode()
+        self._sock.sendall((
+            "GET /rpc HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: %s\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n" % (self.host, key)).encode())
+
+        while b'\r\n\r\n' not in self._buffer:
+            self._fill()
+        head, _, self._buffer = self._buffer.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        accept = base64.b64encode(hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()).decode()
+        headers = dict(line.lower().split(': ', 1) for line in lines[1:] if ': ' in line)
+        if ' 101 ' not in lines[0] + ' ' or headers.get('sec-websocket-accept') != accept.lower():
+            raise ConnectionError("WebSocket upgrade refused by %s: %s" % (self.host, lines[0]))
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._send(0x8, b'')
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+
+    def call(self, method, params=None):
+        request = {'id': self._nextId, 'src': self.src, 'method': method}
+        self._nextId += 1
+        if params is not None:
+            request['params'] = params
+        if self._auth is not None:
+            request['auth'] = self._authParams()
+        self._send(0x1, json.dumps(request).encode())
+        return request['id']
+
+    def authenticate(self, error):
+        """Prepare the digest answer to a 401 error frame, the caller then repeats its request."""
+        if not self._password:
+            raise ConnectionError("Shelly %s requires a password" % self.host)
+        challenge = json.loads(error['message'])
+        self._auth = {'realm': challenge['realm'], 'nonce': challenge['nonce'], 'nc': challenge.get('nc', 1)}
+
+    def recv(self):
+        """Return the next JSON frame. socket.timeout when the device stays silent: what was received of
+        a frame stays buffered, the next call carries on with it."""
+        while True:
+            fin, opcode, payload = self._readFrame()
+            if opcode == 0x9:  # ping
+                self._send(0xA, payload)
+            elif opcode == 0x8:
+                raise ConnectionError("WebSocket closed by %s" % self.host)
+            elif opcode in (0x0, 0x1):
+                self._message += payload
+                if fin:
+                    message, self._message = self._message, b''
+                    if self.payloads is not None:
+                        self.payloads.add('websocket', None, message)
+                    return json.loads(message.decode('utf-8'))
+
+    def _authParams(self):
+        def sha256(text):
+            return hashlib.sha256(text.encode()).hexdigest()
+        cnonce = base64.b16encode(os.urandom(8)).decode().lower()
+        ha1 = sha256('%s:%s:%s' % (self._username, self._auth['realm'], self._password))
+        ha2 = sha256('dummy_method:dummy_uri')
+        return {
+            'realm': self._auth['realm'], 'username': self._username, 'nonce': self._auth['nonce'],
+            'cnonce': cnonce, 'algorithm': 'SHA-256',
+            'response': sha256('%s:%s:%s:%s:auth:%s' % (ha1, self._auth['nonce'], self._auth['nc'], cnonce, ha2))}
+
+    def _send(self, opcode, payload):
+        # client frames are always masked
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self._sock.sendall(header + mask + masked)
+
+    def _readFrame(self):
+        # A frame is only taken from the buffer once it is complete, so a timeout never leaves half of one read
+        while True:
+            frame = self._parseFrame()
+            if frame is not None:
+                return frame
+            self._fill()
+
+    def _parseFrame(self):
+        buffer = self._buffer
+        if len(buffer) < 2:
+            return None
+        first, second = buffer[0], buffer[1]
+        length, start = second & 0x7F, 2
+        if length == 126:
+            if len(buffer) < 4:
+                return None
+            length, start = struct.unpack('!H', buffer[2:4])[0], 4
+        elif length == 127:
+            if len(buffer) < 10:
+                return None
+            length, start = struct.unpack('!Q', buffer[2:10])[0], 10
+        mask = None
+        if second & 0x80:
+            mask, start = buffer[start:start + 4], start + 4
+        if len(buffer) < start + length:
+            return None
+        payload, self._buffer = buffer[start:start + length], buffer[start + length:]
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return first & 0x80, first & 0x0F, payload
+
+    def _fill(self):
+        chunk = self._sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("WebSocket connection to %s lost" % self.host)
+        self._buffer += chunk
+
+
+class PollScheduler:
+    """Polls the meters in 'thread' mode from one small pool of worker threads.
+
+    The first polls are spread over the poll interval so the meters are not all requested at the
+    same moment. A meter is rescheduled only once its previous poll is over: a meter stuck in a
+    timeout holds a single worker and never delays the others.
+    """
+
+    def __init__(self, meters, workers=POLL_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=min(workers, len(meters)), thread_name_prefix='shelly-poll')
+        self._condition = threading.Condition()
+        self._due = []  # heap of (time, sequence, meter)
+        self._sequence = itertools.count()
+        now = time.time()
+        for index, meter in enumerate(meters):
+            self._schedule(meter, now + index * meter.interval / len(meters))
+        self._thread = threading.Thread(target=self._run, name='shelly-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _schedule(self, meter, when):
+        with self._condition:
+            heapq.heappush(self._due, (when, next(self._sequence), meter))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.time():
+                    self._condition.wait(self._due[0][0] - time.time() if self._due else None)
+                _, _, meter = heapq.heappop(self._due)
+            self._executor.submit(self._poll, meter)
+
+    def _poll(self, meter):
+        started = time.time()
+        try:
+            delay = meter.poll()
+        except Exception as e:
+            logging.critical('Error at %s', 'poll', exc_info=e)
+            delay = meter.interval
+        # keep the request rate, a slow answer shortens the next pause
+        self._schedule(meter, started + delay)
+
+
+class AcquisitionStats:
+    """Health figures of one meter: rolling round trip times per RPC method and tick latencies, in
+    seconds, and the failure counters since startup. Fed from the poll threads and read from the main loop."""
+
+    def __init__(self, window=STATS_WINDOW):
+        self._lock = threading.Lock()
+        self._window = window
+        self._rtt = {}  # RPC method -> deque of round trip times
+        self._ticks = collections.deque(maxlen=window)
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.jsonErrors = 0
+        self.lastSuccess = None  # time.monotonic() of the last good reading
+
+    def request(self, method, seconds, failure=None):
+        """Account one RPC call. failure is None, 'timeout', 'error' or 'json'."""
+        with self._lock:
+            self.requests += 1
+            if failure is None:
+                samples = self._rtt.get(method)
+                if samples is None:
+                    samples = self._rtt[method] = collections.deque(maxlen=self._window)
+                samples.append(seconds)
+                self.lastSuccess = time.monotonic()
+            elif failure == 'timeout':
+                self.timeouts += 1
+            elif failure == 'json':
+                self.jsonErrors += 1
+            else:
+                self.errors += 1
+
+    def invalid(self):
+        """An answer that could not be decoded, received without a request (a datagram)."""
+        with self._lock:
+            self.jsonErrors += 1
+
+    def received(self):
+        """A reading arrived without a request (pushed by the Shelly)."""
+        with self._lock:
+            self.lastSuccess = time.monotonic()
+
+    def tick(self, seconds):
+        """Time from the start of an acquisition to its publication on D-Bus."""
+        with self._lock:
+            self._ticks.append(seconds)
+
+    def rtt(self, method):
+        with self._lock:
+            return self._percentiles(self._rtt.get(method, ()))
+
+    def tickLatency(self):
+        with self._lock:
+            return self._percentiles(self._ticks)
+
+    def lastSuccessAge(self):
+        last = self.lastSuccess
+        return None if last is None else time.monotonic() - last
+
+    @staticmethod
+    def _percentiles(samples):
+        # (p50, p95, p99) or (None, None, None) before the first sample
+        if not samples:
+            return None, None, None
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return tuple(ordered[min(last, int(len(ordered) * share))] for share in (0.5, 0.95, 0.99))
+
+
+# Victron D-Bus service of each role. A role is enabled when the Phase of its section is not OFF.
+ROLES = {
+    'PVINVERTER': {'servicename': 'com.victronenergy.pvinverter', 'productid': 41281},  # id assigned by Victron Support from SDM630v2.py
+    'GRID': {'servicename': 'com.victronenergy.grid', 'productid': 45069},
+    'GENSET': {'servicename': 'com.victronenergy.genset', 'productid': 45069},
+}
+
+# EMData counters estimated between two readings when EnergyInterval is set
+ENERGY_KEYS = tuple('%s_total_act%s_energy' % (phase, kind) for phase in 'abc' for kind in ('', '_ret'))
+
+# RPC methods whose round trip percentiles are published, under /Diagnostics/Rtt/<name>
+RTT_ENDPOINTS = {
+    'Shelly.GetStatus': 'Status',
+    'EM.GetStatus': 'Em',
+    'EMData.GetStatus': 'EmData',
+}
+
+# Meter health published by every role, next to /Latency
+DIAGNOSTIC_PATHS = tuple(
+    ['/Diagnostics/Rtt/%s/%s' % (name, rank) for name in RTT_ENDPOINTS.values() for rank in ('P50', 'P95', 'P99')] +
+    ['/Diagnostics/TickLatency/P50', '/Diagnostics/TickLatency/P95', '/Diagnostics/TickLatency/P99',
+     '/Diagnostics/Requests', '/Diagnostics/Timeouts', '/Diagnostics/Errors', '/Diagnostics/JsonErrors',
+     '/Diagnostics/DroppedSamples', '/Diagnostics/LastSuccessAge',
+     '/Diagnostics/Udp/Received', '/Diagnostics/Udp/Lost', '/Diagnostics/Udp/Reordered'])
+
+# Aggregates of the phase of each role, see HISTORY_WINDOWS
+HISTORY_PATHS = tuple('/History/%s/%s/%s' % (quantity, name, stat) for quantity in ('Power', 'Voltage', 'Current')
+                      for name, _ in HISTORY_WINDOWS for stat in ('Min', 'Max', 'Mean'))
+
+# config.ini key holding the deadband of the paths ending with each name
+DEADBANDS = {
+    'Power': 'Deadband_Power',
+    'Voltage': 'Deadband_Voltage',
+    'Current': 'Deadband_Current',
+    'Forward': 'Deadband_Energy',
+    'Reverse': 'Deadband_Energy',
+}
+# deadband used when config.ini does not set it, by config.ini key
+DEADBAND_DEFAULTS = {
+    'Deadband_Power': '1',
+    'Deadband_Voltage': '0.1',
+    'Deadband_Current': '0.01',
+    'Deadband_Energy': '0.01',
+}
+
+
+def read_device_cache():
+    try:
+        with open(DEVICE_CACHE_FILE) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
 
-        # Initialize default URLs
-        self._status_url = None
-        self._config_url = None
-        self._energy_url = None
 
-        # Prepare URLs only once
-        self._status_url, self._config_url, self._energy_url = self._getShellyStatusUrl()
+def write_device_cache(cache):
+    # write aside and rename, a power cut never leaves a truncated file
+    try:
+        with open(DEVICE_CACHE_FILE + '.tmp', 'w') as temporary:
+            json.dump(cache, temporary, indent=2, sort_keys=True)
+        os.replace(DEVICE_CACHE_FILE + '.tmp', DEVICE_CACHE_FILE)
+    except OSError as e:
+        logging.warning("Cannot write %s: %s", DEVICE_CACHE_FILE, e)
 
-        self._dbusservice.add_path('/HardwareVersion', self._getShellyFWVersion())
-        self._dbusservice.add_path('/Position', int(self.config['PVINVERTER']['ACPosition']))
-        self._dbusservice.add_path('/Serial', self._getShellySerial())
-        self._dbusservice.add_path('/UpdateIndex', 0)
-        self._dbusservice.add_path('/StatusCode', 8)  # Dummy path so VRM detects us as a PV-inverter.
-        # 0=Startup 0; 1=Startup 1; 2=Startup 2; 3=Startup 3; 4=Startup 4; 5=Startup 5; 6=Startup 6; 7=Running; 8=Standby; 9=Boot loading; 10=Error
 
-        # add paths without units
-        for path in paths_wo_unit:
-            self._dbusservice.add_path(path, None)
+def process_age():
+    # seconds since this process was started, None where /proc is not available
+    try:
+        with open('/proc/self/stat') as stat:
+            started = int(stat.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime') as uptime:
+            return float(uptime.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ConfigWatcher:
+    """Calls reload() from the main loop when config.ini changes, once it has stayed unchanged for
+    CONFIG_SETTLE_DELAY ms. The file is watched with a Gio file monitor (inotify), or its modification
+    time is checked every CONFIG_POLL_INTERVAL seconds where Gio is not available."""
+
+    def __init__(self, path, reload):
+        self._path = path
+        self._reload = reload
+        self._stamp = self._stat()
+        self._settle = None
+        self._monitor = None
+        try:
+            from gi.repository import Gio
+            self._monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            self._monitor.connect('changed', self._changed)
+        except (ImportError, AttributeError, gobject.Error) as e:
+            logging.info("Checking %s every %d s, no file monitor: %s", path, CONFIG_POLL_INTERVAL, e)
+            gobject.timeout_add(CONFIG_POLL_INTERVAL * 1000, self._poll)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
-        # add path values to dbus
-        for path, settings in self._paths.items():
-            self._dbusservice.add_path(
-                path, settings['initial'], gettextcallback=settings['textformat'], writeable=True,
-                onchangecallback=self._handlechangedvalue)
-        self._dbusservice.register()
-        # last update
-        self._lastUpdate = 0
+    def _changed(self, monitor, file, other_file, event):
+        # an editor saving the file may send several events, and replace the file along the way
+        if self._settle is not None:
+            gobject.source_remove(self._settle)
+        self._settle = gobject.timeout_add(CONFIG_SETTLE_DELAY, self._settled)
 
+    def _poll(self):
+        if self._settle is None and self._stat() != self._stamp:
+            self._settle = gobject.timeout_add(CONFIG_SETTLE_DELAY, self._settled)
+        return True
 
-        # add _update function 'timer'
-        gobject.timeout_add(1000, self._update)  # pause 1000ms before the next request
+    def _settled(self):
+        self._settle = None
+        stamp = self._stat()
+        if stamp is not None and stamp != self._stamp:
+            self._stamp = stamp
+            self._reload()
+        return False
 
-    def _getShellySerial(self):
-        meter_data = self._getShellyGetConfig()
-        if meter_data is not None:
-            if not meter_data['device']['mac']:
-                raise ValueError("Response does not contain 'mac' attribute")
 
-            serial = meter_data['device']['mac']
-        else:
-            serial = None
-        return serial
+def enabled_roles(config, name=''):
+    """(role, config section) of the roles enabled for the meter called name, '' being the first meter."""
+    suffix = ':' + name if name else ''
+    for role in ROLES:
+        if role + suffix in config and config[role + suffix].get('Phase', 'OFF').strip().upper() != 'OFF':
+            yield role, config[role + suffix]
 
-    def _getShellyFWVersion(self):
-        meter_data = self._getShellyGetConfig()
-        if meter_data is not None:
-            if not meter_data['device']['fw_id']:
-                raise ValueError("Response does not contain 'device/fw_id' attribute")
 
-            ver = meter_data['device']['fw_id']
-        else:
-            ver = None
-        return ver
-
-    def _getConfig(self):
-        config = configparser.ConfigParser()
-        config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
-        return config
-
-    def _getShellyStatusUrl(self):
-        URL = "http://%s:%s@%s/rpc/EM.GetStatus?id=0" % (
-            self.config['SHELLY_CONNECTION']['Username'],
-            self.config['SHELLY_CONNECTION']['Password'],
-            self.config['SHELLY_CONNECTION']['Host']
-        )
-        URL = URL.replace(":@", "")
-        URL_Config = "http://%s:%s@%s/rpc/Sys.GetConfig?id=0" % (
-            self.config['SHELLY_CONNECTION']['Username'],
-            self.config['SHELLY_CONNECTION']['Password'],
-            self.config['SHELLY_CONNECTION']['Host']
-        )
-        URL_Config = URL_Config.replace(":@", "")
-        URL_Energy = "http://%s:%s@%s/rpc/EMData.GetStatus?id=0" % (
-            self.config['SHELLY_CONNECTION']['Username'],
-            self.config['SHELLY_CONNECTION']['Password'],
-            self.config['SHELLY_CONNECTION']['Host']
-        )
-        URL_Energy = URL_Energy.replace(":@", "")
-        return URL, URL_Config, URL_Energy
+def meter_names(config):
+    """Names of the meters of config.ini: '' for [SHELLY_CONNECTION], then one per [SHELLY_CONNECTION:<name>]."""
+    return [''] + [section.split(':', 1)[1] for section in config.sections() if section.startswith('SHELLY_CONNECTION:')]
 
-    def _getShellyGetConfig(self):
 
-        if self._status_url is None or self._config_url is None:
-            logging.warning("URLs Shelly non définies. Impossible de récupérer la configuration.")
-            return None
+def dbus_connection():
+    """Private connection to the bus for one D-Bus service. On a shared connection the second service
+    would register /Mgmt/ProcessName, /Ac/Power... again, which dbus-python refuses."""
+    if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+        return dbus.SessionBus(private=True)
+    return dbus.SystemBus(private=True)
 
-        logging.info(" URL : %s, URLConfig : %s", self._status_url, self._config_url)
-        try:
-            meter_r = requests.get(url=self._config_url, timeout=5)
 
-            # check for response
-            if not meter_r:
-                raise ConnectionError("No response from Shelly EM - %s" % (self._config_url))
+def service_name(role, section):
+    """D-Bus service name of a role, from the Deviceinstance of its section."""
+    return "{}.http_{:02d}".format(ROLES[role]['servicename'], int(section['Deviceinstance']))
 
-            meter_data = meter_r.json()
-            self._dbusservice['/Connected'] = 1
 
-            for key, value in meter_data.items():
-                logging.info(" _getShellyGetConfig meter_data['%s'] : %s", key, value)
-            # check for Json
-            if not meter_data:
-                raise ValueError("Converting response to JSON failed")
-        except requests.exceptions.RequestException as e:
-            logging.error("Error accessing URL: %s %s", self._config_url, e)
-            meter_data = None
-            self._dbusservice['/Connected'] = 0
+def check_udp_ports(config, names):
+    """Raise ValueError when two meters called names with Ingest = udp listen on the same UdpPort."""
+    ports = {}
+    for name in names:
+        connection = config['SHELLY_CONNECTION' + (':' + name if name else '')]
+        if connection.get('Ingest', 'poll').lower() == 'udp':
+            ports.setdefault(int(connection.get('UdpPort', '5600')), []).append(name or 'SHELLY_CONNECTION')
+    duplicates = ['%d (%s)' % (port, ', '.join(meters)) for port, meters in sorted(ports.items()) if len(meters) > 1]
+    if duplicates:
+        raise ValueError("Same UdpPort used by several meters: %s, give each meter its own UdpPort" % "; ".join(duplicates))
 
-        return meter_data
 
-    def _getShellyData(self):
-        if self._status_url is None:
-            logging.warning("Status URL Shelly non définie. Impossible de récupérer les données.")
-            return None
+def check_service_names(config, names):
+    """Raise ValueError when two enabled roles of the meters called names would get the same D-Bus service."""
+    servicenames = [service_name(role, section) for name in names for role, section in enabled_roles(config, name)]
+    duplicates = set(servicename for servicename in servicenames if servicenames.count(servicename) > 1)
+    if duplicates:
+        raise ValueError("Same Deviceinstance used twice for %s, give each role section its own Deviceinstance" % ", ".join(sorted(duplicates)))
 
-        try:
-            meter_r = requests.get(url=self._status_url, timeout=5)
-            
-            # check for response
-            if not meter_r:
-                raise ConnectionError("No response from Shelly EM - %s" % (self._status_url))
-            self._dbusservice['/Connected'] = 1
-            meter_data = meter_r.json()
 
-            # check for Json
-            if not meter_data:
-                raise ValueError("Converting response to JSON failed")
-        except requests.exceptions.RequestException as e:
-            logging.error("Error accessing URL: %s %s", self._status_url, e)
-            meter_data = None
-            self._dbusservice['/Connected'] = 0
+def reload_config(config_file, meters, names):
+    """Main loop: apply config_file again to the running meters. All of it is checked first, an invalid
+    file changes nothing. names are the meters of the file applied last, only to warn once about a meter
+    added or removed. Returns the meters of config_file, or names when it was not applied."""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file)
+        new_names = meter_names(config)
+        running = [meter for meter in meters if meter.name in new_names]
+        check_service_names(config, [meter.name for meter in running])
+        prepared = [(meter, meter.prepareConfig(config)) for meter in running]
+    except (configparser.Error, ValueError, KeyError) as e:
+        logging.error("config.ini not applied, keeping the running settings: %s", e)
+        return names
+    for name in sorted(set(names) ^ set(new_names)):
+        logging.warning("[SHELLY_CONNECTION:%s] added or removed, restart the service to apply it", name)
+    logging.getLogger().setLevel(get_log_level(config))
+    for meter, settings in prepared:
+        try:
+            meter.applyConfig(config, settings)
+        except Exception as e:
+            logging.critical('Error at %s', 'applyConfig', exc_info=e)
+    logging.info("config.ini reloaded, log level %s", logging.getLevelName(logging.getLogger().level))
+    return new_names
+
+
+class ShellyPro3EM:
+    """Acquisition side: polls (or receives pushes from) one Shelly Pro 3EM and fans each
+    reading out to the D-Bus service of every enabled role."""
+
+    def __init__(self, config, paths, name=''):
+        # The first meter uses [SHELLY_CONNECTION], [PVINVERTER], [GRID] and [GENSET],
+        # a meter called 'garage' uses [SHELLY_CONNECTION:garage], [PVINVERTER:garage]...
+        self.config = config
+        self.name = name
+        suffix = ':' + name if name else ''
+        self._connection = self.config['SHELLY_CONNECTION' + suffix]
+        self._connected = 1
+        self._payloadsDumped = False
+        self._failures = 0
+        self.stats = AcquisitionStats()
+        self._droppedSamples = 0
+
+        # Adaptive polling: the interval shrinks towards MinInterval while the power moves by more than
+        # PowerChangeThreshold between two readings, and grows towards MaxInterval while it is flat.
+        # These, EnergyInterval and Smoothing follow the changes of config.ini (see applyConfig).
+        self._minInterval, self._maxInterval, self._powerThreshold, self._energyInterval, self._smoothing = \
+            self._readTimings(self._connection)
+        self._lastPowers = None
+        self.interval = self._minInterval  # seconds until the next request
+        self._retryAt = 0
+        self._reachable = True
+
+        # Tiered refresh: with EnergyInterval set, the energy counters are only read every EnergyInterval
+        # seconds and the fast ticks request EM.GetStatus alone
+        self._energyDue = 0
+        self._energy = {}           # counters of the last reading + integrated power since, in Wh
+        self._energyPublished = {}  # highest value handed out for each counter
+        self._energyData = None
+        self._energyTime = 0
+        self._phasePowers = {}
+
+        # Per-phase history of the readings, in a memory-mapped HistoryFile when set so that a restart keeps it.
+        # With Smoothing, the voltage, current and power published are their mean over that many seconds.
+        self.history = None
+        if self._connection.get('History', '1') == '1':
+            self.history = SampleHistory(self._connection.get('HistoryFile', '') or None)
+        if self._smoothing and self.history is None:
+            logging.warning("Smoothing needs History = 1, publishing the raw readings of %s", self._connection['Host'])
+            self._smoothing = 0
+
+        # The last PayloadBuffer answers of the Shelly, written to disk on error or on SIGUSR1
+        payload_buffer = int(self._connection.get('PayloadBuffer', '20'))
+        self._payloads = PayloadRing(payload_buffer) if payload_buffer > 0 else None
+
+        # One keep-alive connection to the Shelly, shared by all the RPC calls
+        self._rpc = ShellyRpcClient(
+            self._connection['Host'],
+            self._connection.get('Username', ''),
+            self._connection.get('Password', ''),
+            timeout=float(self._connection.get('Timeout', '5')),
+            payloads=self._payloads)
+        # Read power and energy with one Shelly.GetStatus request instead of EM.GetStatus + EMData.GetStatus
+        self._singleRequest = self._connection.get('SingleRequest', '1') == '1'
+
+        # http: the readings are requested over RPC
+        # modbus: they are read from the Modbus TCP registers, Sys.GetConfig still goes over RPC
+        self._modbus = None
+        transport = self._connection.get('Transport', 'http').lower()
+        valid_transports = {'http', 'modbus'}
+        if transport not in valid_transports:
+            logging.warning("Transport value '%s' is not valid. Must be one of %s. Using 'http' as default.", transport, valid_transports)
+            transport = 'http'
+        if transport == 'modbus':
+            self._modbus = ShellyModbusClient(
+                self._connection['Host'],
+                port=int(self._connection.get('ModbusPort', '502')),
+                unit=int(self._connection.get('ModbusUnit', '1')),
+                timeout=float(self._connection.get('Timeout', '5')),
+                payloads=self._payloads)
+            self._singleRequest = False
+        # client of the readings
+        self._client = self._modbus or self._rpc
+
+        # Register at once with the identity cached by the previous run: Sys.GetConfig is requested in the
+        # background and /Serial and /HardwareVersion are only updated if the device changed.
+        self._device = read_device_cache().get(self._rpc.host, {})
+        self._rolePaths = paths
+        self.roles = [self._createRole(role, section) for role, section in enabled_roles(self.config, name)]
+        if not self.roles:
+            logging.warning("No role enabled for %s, set the Phase of [PVINVERTER%s], [GRID%s] or [GENSET%s] in config.ini",
+                            self._rpc.host, suffix, suffix, suffix)
+
+        # blocking: the requests run inside the GLib timer (legacy behaviour)
+        # thread: a worker thread polls the Shelly and hands the result back to the main loop
+        self.pollMode = self._connection.get('PollMode', 'thread').lower()
+        valid_poll_modes = {'blocking', 'thread'}
+        if self.pollMode not in valid_poll_modes:
+            logging.warning("PollMode value '%s' is not valid. Must be one of %s. Using 'thread' as default.", self.pollMode, valid_poll_modes)
+            self.pollMode = 'thread'
+
+        # poll: request the data every tick
+        # websocket: the Shelly pushes its changes, polling only runs while the socket is down
+        # udp: the script shelly/udp-push.js sends each reading in a datagram, polling only runs while they stop
+        self._ingest = self._connection.get('Ingest', 'poll').lower()
+        valid_ingests = {'poll', 'websocket', 'udp'}
+        if self._ingest not in valid_ingests:
+            logging.warning("Ingest value '%s' is not valid. Must be one of %s. Using 'poll' as default.", self._ingest, valid_ingests)
+            self._ingest = 'poll'
+        if self._ingest != 'poll' and self.pollMode == 'blocking':
+            logging.warning("Ingest '%s' needs PollMode 'thread', switching the fallback polling to a thread.", self._ingest)
+            self.pollMode = 'thread'
+        self._pushActive = False
+
+        if self.pollMode == 'thread':
+            # polled by the PollScheduler shared by all the meters
+            self._sampleLock = threading.Lock()
+            self._pendingSample = None
+            self._pollStop = threading.Event()
+        else:
+            # add _update function 'timer'
+            gobject.timeout_add(int(self.interval * 1000), self._update)
+
+        if self._ingest == 'websocket':
+            self._pushThread = threading.Thread(target=self._websocketLoop, name='shelly-websocket')
+            self._pushThread.daemon = True
+            self._pushThread.start()
+        # sequence number of the last datagram applied, counters of the datagrams received, lost and out of order
+        self._udpSession = self._udpSequence = None
+        self._udpLast = 0
+        self._udpReceived = self._udpLost = self._udpReordered = 0
+        if self._ingest == 'udp':
+            self._openUdp(int(self._connection.get('UdpPort', '5600')))
+
+        self._deviceThread = threading.Thread(target=self._fetchDevice, name='shelly-device')
+        self._deviceThread.daemon = True
+        self._deviceThread.start()
+
+        # meter health on D-Bus, and a summary line in the log every SummaryInterval seconds
+        gobject.timeout_add(STATS_PUBLISH_INTERVAL * 1000, self._publishStats)
+        summary_interval = float(self._connection.get('SummaryInterval', '300'))
+        if summary_interval > 0:
+            gobject.timeout_add(int(summary_interval * 1000), self._logSummary)
+
+    def _readTimings(self, connection):
+        # MinInterval and MaxInterval (s), PowerChangeThreshold, EnergyInterval and Smoothing of a [SHELLY_CONNECTION] section
+        min_interval = float(connection.get('MinInterval', '500')) / 1000.0
+        max_interval = max(min_interval, float(connection.get('MaxInterval', '2000')) / 1000.0)
+        return (min_interval, max_interval, float(connection.get('PowerChangeThreshold', '20')),
+                float(connection.get('EnergyInterval', '0')), float(connection.get('Smoothing', '0')))
+
+    def _createRole(self, role, section):
+        return DbusShellyEMService(
+            role, ROLES[role]['servicename'], self._rolePaths[role], section,
+            productid=ROLES[role]['productid'], serial=self._device.get('mac'), fwversion=self._device.get('fw_id'),
+            connected=self._connected)
+
+    def prepareConfig(self, config):
+        """Check the sections of this meter in a new config.ini, without applying anything.
+        Raises ValueError or KeyError on an invalid value, returns what applyConfig() takes."""
+        suffix = ':' + self.name if self.name else ''
+        connection = config['SHELLY_CONNECTION' + suffix]
+        roles = [(role, section, service_name(role, section), DbusShellyEMService._compilePlan(role, section))
+                 for role, section in enabled_roles(config, self.name)]
+        return connection, self._readTimings(connection), roles
+
+    def applyConfig(self, config, prepared):
+        """Main loop: switch to the settings of a new config.ini checked by prepareConfig(). The roles are
+        only used from the main loop, each one swaps its plan at once and keeps its D-Bus service, so the
+        readings are published without a gap. Only a role whose D-Bus service name changes (Deviceinstance),
+        or that is enabled or disabled, is registered again."""
+        connection, timings, roles = prepared
+        changed = [key for key in CONFIG_RESTART_KEYS if connection.get(key) != self._connection.get(key)]
+        if changed:
+            logging.warning("%s changed for %s, restart the service to apply it", ", ".join(changed), self._rpc.host)
+
+        # the poll thread reads these between two requests, each assignment is atomic
+        self._minInterval, self._maxInterval, self._powerThreshold, self._energyInterval, smoothing = timings
+        self.interval = min(max(self.interval, self._minInterval), self._maxInterval)
+        if smoothing and self.history is None:
+            logging.warning("Smoothing needs History = 1, publishing the raw readings of %s", self._rpc.host)
+            smoothing = 0
+        self._smoothing = smoothing
+
+        current = {role.role: role for role in self.roles}
+        kept, added = {}, []
+        for role, section, servicename, plan in roles:
+            service = current.get(role)
+            if service is not None and service.servicename == servicename:
+                service.reconfigure(section, plan)
+                kept[role] = current.pop(role)
+            else:
+                added.append((role, section))
+        # unregister first: a Deviceinstance may move from one role to another
+        for service in current.values():
+            logging.info("Unregistering %s", service.servicename)
+            service.unregister()
+        for role, section in added:
+            kept[role] = self._createRole(role, section)
+            logging.info("Registered %s", kept[role].servicename)
+        self.roles = [kept[role] for role, _, _, _ in roles]
+        self.config = config
+        self._connection = connection
+
+    def _getShellyDevice(self):
+        # MAC and firmware of the meter, shared by all the roles
+        meter_data = self._getShellyGetConfig()
+        if meter_data is None:
+            return None
+        device = meter_data.get('device')
+        if not device:
+            raise ValueError("Response does not contain 'device' attribute")
+        if not device.get('mac'):
+            raise ValueError("Response does not contain 'mac' attribute")
+        if not device.get('fw_id'):
+            raise ValueError("Response does not contain 'device/fw_id' attribute")
+        return device
+
+    def _fetchDevice(self):
+        # Background thread: Sys.GetConfig once, retried until the Shelly answers
+        while True:
+            try:
+                device = self._getShellyDevice()
+            except ValueError as e:
+                logging.error("Sys.GetConfig of %s: %s", self._rpc.host, e)
+                return
+            if device is not None:
+                gobject.idle_add(self._applyDevice, device)
+                return
+            time.sleep(DEVICE_RETRY_INTERVAL)
+
+    def _applyDevice(self, device):
+        # main loop: publish the identity read from the Shelly and keep it for the next start
+        if device.get('mac') != self._device.get('mac') or device.get('fw_id') != self._device.get('fw_id'):
+            if self._device:
+                logging.warning("Shelly %s is now %s, firmware %s (was %s, firmware %s)", self._rpc.host,
+                                device.get('mac'), device.get('fw_id'), self._device.get('mac'), self._device.get('fw_id'))
+            for role in self.roles:
+                role.publishValues({'/Serial': device.get('mac'), '/HardwareVersion': device.get('fw_id')}, index=False)
+        if device != self._device:
+            cache = read_device_cache()
+            cache[self._rpc.host] = device
+            write_device_cache(cache)
+        self._device = device
+        return False
 
+    def _getShellyGetConfig(self):
+        # device thread: the outcome is not the poll's, self._connected is left alone
+        meter_data, _ = self._callShelly('Sys.GetConfig', id=0)
+        if meter_data is not None:
+            device = meter_data.get('device') or {}
+            logging.info("Shelly %s: MAC %s, firmware %s", self._rpc.host, device.get('mac'), device.get('fw_id'))
         return meter_data
 
-    def _getShellyEnergyData(self):
-        if self._energy_url is None:
-            logging.warning("Energy URL Shelly non définie. Impossible de récupérer les données d'énergie.")
-            return None
+    def _getShellyData(self):
+        return self._request('EM.GetStatus', id=0)
 
+    def _getShellyEnergyData(self):
+        return self._request('EMData.GetStatus', id=0)
+
+    def _getShellyStatus(self):
+        # EM and EMData readings of the same instant, in a single round trip
+        status = self._request('Shelly.GetStatus')
+        if status is None:
+            if self._rpc.lastStatusCode in (400, 404):
+                logging.warning("Shelly.GetStatus is not supported by this firmware, using EM.GetStatus and EMData.GetStatus")
+                self._singleRequest = False
+            return None, None
+
+        meter_data = status.get('em:0')
+        energy_data = status.get('emdata:0')
+        if meter_data is None or energy_data is None:
+            logging.warning("Shelly.GetStatus does not contain 'em:0' and 'emdata:0', using EM.GetStatus and EMData.GetStatus")
+            self._singleRequest = False
+        return meter_data, energy_data
+
+    def _request(self, method, **params):
+        # A request of the poll: its outcome is the connection state of the meter
+        data, error = self._callShelly(method, **params)
+        if error is None:
+            self._connected = 1
+            self._payloadsDumped = False
+            return data
+        # what led to the error: dumped on the first failure of a streak only, not while the meter stays down
+        # or keeps sending garbage
+        if not self._payloadsDumped:
+            self._payloadsDumped = True
+            self.dumpPayloads("%s failed: %s" % (method, error))
+        self._connected = 0
+        return None
+
+    def _callShelly(self, method, **params):
+        # Returns the response and the error, None when there is none. Touches nothing but the statistics:
+        # it runs in the poll thread as well as in the device thread.
+        started = time.monotonic()
+        error = None
+        failure = None
+        client = self._modbus if self._modbus is not None and method in MODBUS_BLOCKS else self._rpc
         try:
-            meter_r = requests.get(url=self._energy_url, timeout=5)
-            # check for response
-            if not meter_r:
-                raise ConnectionError("No response from Shelly EM Energy - %s" % (self._energy_url))
-            self._dbusservice['/Connected'] = 1
-            energy_data = meter_r.json()
+            data = client.get(method, **params)
 
             # check for Json
-            if not energy_data:
-                raise ValueError("Converting energy response to JSON failed")
-        except requests.exceptions.RequestException as e:
-            logging.error("Error accessing Energy URL: %s %s", self._energy_url, e)
-            energy_data = None
-            self._dbusservice['/Connected'] = 0
-
-        return energy_data
-
-    def _signOfLife(self):
-        logging.info("--- Start: sign of life ---")
-        logging.info("Last _update() call: %s" % (self._lastUpdate))
-        logging.info("Last '/Ac/Power': %s" % (self._dbusservice['/Ac/Power']))
-        logging.info("--- End: sign of life ---")
+            if not data:
+                raise ValueError("Converting %s response to JSON failed" % method)
+        except (OSError, ValueError) as e:  # requests' exceptions are OSErrors
+            logging.error("Error calling %s on %s: %s", method, client.host, e)
+            data = None
+            error = e
+            # requests' JSONDecodeError is a ValueError as well
+            if isinstance(e, socket.timeout) or (requests is not None and isinstance(e, requests.exceptions.Timeout)):
+                failure = 'timeout'
+            elif isinstance(e, ValueError):
+                failure = 'json'
+            else:
+                failure = 'error'
+        self.stats.request(method, time.monotonic() - started, failure)
+
+        return data, error
+
+    def dumpPayloads(self, reason):
+        if self._payloads is not None:
+            name = ''.join(c if c.isalnum() else '_' for c in self._rpc.host)
+            self._payloads.dump(PAYLOAD_DUMP_FILE % name, reason)
+
+    def _publishStats(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        tick = self.stats.tickLatency()
+        age = self.stats.lastSuccessAge()
+        values = {
+            '/Latency': ms(tick[0]),
+            '/Diagnostics/TickLatency/P50': ms(tick[0]),
+            '/Diagnostics/TickLatency/P95': ms(tick[1]),
+            '/Diagnostics/TickLatency/P99': ms(tick[2]),
+            '/Diagnostics/Requests': self.stats.requests,
+            '/Diagnostics/Timeouts': self.stats.timeouts,
+            '/Diagnostics/Errors': self.stats.errors,
+            '/Diagnostics/JsonErrors': self.stats.jsonErrors,
+            '/Diagnostics/DroppedSamples': self._droppedSamples,
+            '/Diagnostics/LastSuccessAge': None if age is None else round(age, 1),
+            '/Diagnostics/Udp/Received': self._udpReceived,
+            '/Diagnostics/Udp/Lost': self._udpLost,
+            '/Diagnostics/Udp/Reordered': self._udpReordered,
+        }
+        for method, name in RTT_ENDPOINTS.items():
+            for rank, value in zip(('P50', 'P95', 'P99'), self.stats.rtt(method)):
+                values['/Diagnostics/Rtt/%s/%s' % (name, rank)] = ms(value)
+        now = time.time()
+        for role in self.roles:
+            role.publishValues(values, index=False)
+            if self.history is not None:
+                role.publishHistory(self.history, now)
         return True
 
-    def _update(self):
-        try:
-            # get data from Shelly
+    def _logSummary(self):
+        # one line per meter instead of a line per reading: readable at INFO level over weeks
+        def ms(values):
+            return '/'.join('-' if value is None else '%.0f' % (value * 1000) for value in values)
+
+        rtts = [(method, self.stats.rtt(method)) for method in RTT_ENDPOINTS]
+        rtt = ', '.join('%s %s' % (method, ms(values)) for method, values in rtts if values[0] is not None)
+        age = self.stats.lastSuccessAge()
+        sent, reused, opened = self._client.stats()
+        udp = ''
+        if self._ingest == 'udp':
+            udp = ', %d datagrams (%d lost, %d out of order)' % (self._udpReceived, self._udpLost, self._udpReordered)
+        logging.info("Shelly %s: %d requests (%d timeouts, %d errors, %d JSON failures), %d connections opened "
+                     "(%d of %d requests on a reused one)%s, "
+                     "RTT p50/p95/p99 ms: %s, tick latency %s ms, %d dropped samples, last success %s, interval %.1fs, %s",
+                     self._rpc.host, self.stats.requests, self.stats.timeouts, self.stats.errors, self.stats.jsonErrors,
+                     opened, reused, sent, udp, rtt or '-', ms(self.stats.tickLatency()), self._droppedSamples,
+                     'never' if age is None else '%.1fs ago' % age, self.interval,
+                     'pushing' if self._pushActive else 'connected' if self._connected else 'disconnected')
+        return True
+
+    def _fetchSample(self):
+        # Network part of a tick. Must not touch the D-Bus service: in 'thread' mode it runs in the poll thread.
+        now = time.time()
+        if self._energyInterval and self._energy and now < self._energyDue:
+            # fast tier: power only, the energy counters are estimated from it
+            meter_data = self._getShellyData()
+            if meter_data is None:
+                return None, None
+            return meter_data, self._integrateEnergy(meter_data, now)
+
+        if self._singleRequest:
+            meter_data, energy_data = self._getShellyStatus()
+            if not self._singleRequest:
+                meter_data = self._getShellyData()
+                energy_data = self._getShellyEnergyData()
+        else:
             meter_data = self._getShellyData()
             energy_data = self._getShellyEnergyData()
 
+        if self._energyInterval and meter_data is not None and energy_data is not None:
+            self._energyDue = now + self._energyInterval
+            energy_data = self._anchorEnergy(meter_data, energy_data, now)
+        return meter_data, energy_data
+
+    def _anchorEnergy(self, meter_data, energy_data, now):
+        # Fresh EMData reading: restart the estimation from it. The value published can only stay above the
+        # reading by what was estimated on top of the previous reading: a reading below the previous one means
+        # the counters were reset on the Shelly, and the new count is published as is.
+        previous = self._energyData or {}
+        for key in ENERGY_KEYS:
+            value, last = energy_data.get(key), previous.get(key)
+            if key in self._energyPublished and value is not None and (last is None or value < last):
+                if value < self._energyPublished[key]:
+                    logging.warning("Energy counter %s of %s went back from %.0f to %.0f Wh, publishing the new count",
+                                    key, self._rpc.host, self._energyPublished[key], value)
+                del self._energyPublished[key]
+        self._energy = {key: energy_data[key] for key in ENERGY_KEYS if energy_data.get(key) is not None}
+        self._energyData = energy_data
+        self._energyTime = now
+        self._phasePowers = {phase: meter_data.get(phase + '_act_power') for phase in 'abc'}
+        return self._estimatedEnergy(energy_data)
+
+    def _integrateEnergy(self, meter_data, now):
+        # Energy counters between two EMData readings: the last reading plus the integral of the power
+        hours = (now - self._energyTime) / 3600.0
+        self._energyTime = now
+        for phase in 'abc':
+            power = meter_data.get(phase + '_act_power')
+            last = self._phasePowers.get(phase)
+            self._phasePowers[phase] = power
+            if power is None or last is None:
+                continue
+            average = (power + last) / 2.0
+            # positive power is consumed (act_energy), negative is returned (act_ret_energy)
+            key = phase + ('_total_act_energy' if average >= 0 else '_total_act_ret_energy')
+            if key in self._energy:
+                self._energy[key] += abs(average) * hours
+        return self._estimatedEnergy(self._energyData)
+
+    def _estimatedEnergy(self, energy_data):
+        # A counter never goes backwards: when the estimate ran ahead of the next reading, it holds
+        # its value until the reading catches up.
+        for key, value in self._energy.items():
+            if key not in self._energyPublished or value > self._energyPublished[key]:
+                self._energyPublished[key] = value
+        estimated = dict(energy_data)
+        estimated.update(self._energyPublished)
+        return estimated
+
+    def poll(self):
+        """One tick in 'thread' mode, called from a PollScheduler worker. Returns the seconds until the next one."""
+        # while the Shelly pushes its data there is nothing to request
+        if self._pushActive:
+            if self._ingest != 'udp' or time.monotonic() - self._udpLast < UDP_SILENCE_TIMEOUT:
+                return self._maxInterval
+            logging.warning("No datagram from %s for %d s, polling until they are back", self._rpc.host, UDP_SILENCE_TIMEOUT)
+            self._pushActive = False
+
+        if self._failures and time.time() < self._retryAt:
+            # Backing off: only knock on the TCP port, and request right away once the Shelly is reachable again
+            reachable = self._client.reachable(POLL_PROBE_TIMEOUT)
+            was_reachable, self._reachable = self._reachable, reachable
+            if not reachable or was_reachable:
+                return max(0, min(self._maxInterval, self._retryAt - time.time()))
+
+        started = time.monotonic()
+        meter_data, energy_data = self._fetchSample()
+        delay = self._nextPollDelay(meter_data)
+        self._queueSample((started, time.monotonic(), 0 if self._failures else 1, meter_data, energy_data))
+        return delay
+
+    def _nextPollDelay(self, meter_data):
+        if not self._connected:
+            self._failures += 1
+            if self._failures == 1:
+                logging.warning("Shelly %s does not answer, backing off", self._rpc.host)
+            # exponential backoff, with jitter so that several dead meters do not retry in step
+            backoff = min(self._maxInterval * 2 ** (self._failures - 1), POLL_MAX_BACKOFF) * random.uniform(0.8, 1.2)
+            self._retryAt = time.time() + backoff
+            return min(backoff, self._maxInterval) if self.pollMode == 'thread' else backoff
+
+        if self._failures:
+            # back from a failure: resume at full speed straight away
+            logging.warning("Shelly %s answers again after %d failed requests", self._rpc.host, self._failures)
+            self._failures = 0
+            self._reachable = True
+            self._lastPowers = None
+            self.interval = self._minInterval
+            return self.interval
+
+        if meter_data is not None:
+            powers = tuple(meter_data.get(key) or 0 for key in ('a_act_power', 'b_act_power', 'c_act_power'))
+            if self._lastPowers is not None:
+                change = max(abs(power - last) for power, last in zip(powers, self._lastPowers))
+                if change >= self._powerThreshold:
+                    self.interval = max(self._minInterval, self.interval / 2)
+                else:
+                    self.interval = min(self._maxInterval, self.interval * 1.5)
+            self._lastPowers = powers
+        return self.interval
+
+    def _websocketLoop(self):
+        ws = ShellyWebSocket(
+            self._connection['Host'],
+            self._connection.get('Username', ''),
+            self._connection.get('Password', ''),
+            payloads=self._payloads)
+        while not self._pollStop.is_set():
+            try:
+                ws.connect()
+                self._websocketSession(ws)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error("WebSocket to %s: %s, polling until it is back", ws.host, e)
+            except Exception as e:
+                # whatever the Shelly sent, the socket is opened again: a dead thread would leave polling for good
+                logging.critical('Error at %s', '_websocketLoop', exc_info=e)
+            finally:
+                self._pushActive = False
+                ws.close()
+            self._pollStop.wait(WEBSOCKET_RECONNECT_DELAY)
+
+    def _websocketSession(self, ws):
+        meter_data = {}
+        energy_data = {}
+        auth_retries = 0
+        # The response to the first request carries the full status and registers us for the notifications
+        pending = ws.call('Shelly.GetStatus')
+        while not self._pollStop.is_set():
+            try:
+                frame = ws.recv()
+            except socket.timeout:
+                if pending is not None:
+                    raise ConnectionError("no answer from %s" % ws.host)
+                # quiet meter: ask for a full status, the answer proves the link is alive
+                pending = ws.call('Shelly.GetStatus')
+                continue
+
+            if not isinstance(frame, dict):
+                logging.warning("Ignoring a WebSocket frame of %s that is not a JSON object", ws.host)
+                continue
+            if frame.get('id') is not None and frame.get('id') == pending:
+                pending = None
+                error = frame.get('error')
+                if error is not None:
+                    # a 401 also comes back when the nonce has expired, give up only if the fresh one fails too
+                    if error.get('code') != 401 or auth_retries > 0:
+                        raise ConnectionError("Shelly.GetStatus failed: %s" % error.get('message'))
+                    auth_retries += 1
+                    ws.authenticate(error)
+                    pending = ws.call('Shelly.GetStatus')
+                    continue
+                auth_retries = 0
+                status = frame['result']
+            elif frame.get('method') in ('NotifyStatus', 'NotifyFullStatus'):
+                status = frame['params']
+            else:
+                continue
+            if not isinstance(status, dict):
+                logging.warning("Ignoring a WebSocket status of %s that is not a JSON object", ws.host)
+                continue
+
+            # NotifyStatus only carries what changed, merged into the last full status
+            changed = False
+            if isinstance(status.get('em:0'), dict):
+                meter_data.update(status['em:0'])
+                changed = True
+            if isinstance(status.get('emdata:0'), dict):
+                energy_data.update(status['emdata:0'])
+                changed = True
+            if changed and meter_data and energy_data:
+                if not self._pushActive:
+                    logging.info("Receiving pushed data from %s, polling suspended", ws.host)
+                    self._pushActive = True
+                self._connected = 1
+                self._failures = 0
+                self.stats.received()
+                received = time.monotonic()
+                self._queueSample((received, received, 1, dict(meter_data), dict(energy_data)))
+
+    def _openUdp(self, port):
+        # Datagrams are read by the main loop as they arrive, no thread involved. Only the Shelly is
+        # listened to when Host is an IP address.
+        hostname = self._rpc.host.partition(':')[0]
+        try:
+            socket.inet_aton(hostname)
+            self._udpSource = hostname
+        except OSError:
+            self._udpSource = None
+        # no SO_REUSEADDR: a second socket on the port would silently get the datagrams of this one
+        self._udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udpSocket.bind(('', port))
+        self._udpSocket.setblocking(False)
+        gobject.io_add_watch(self._udpSocket.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._udpReadable)
+        logging.info("Listening for the datagrams of %s on UDP port %d", self._rpc.host, port)
+
+    def _udpReadable(self, fd, condition):
+        # GLib drops the watch of a callback that raises: UDP ingest would stop for good
+        try:
+            self._udpDrain()
+        except Exception as e:
+            logging.critical('Error at %s', '_udpReadable', exc_info=e)
+        return True  # keep watching
+
+    def _udpDrain(self):
+        # Drain the socket, only the newest reading is published
+        latest = None
+        while True:
+            try:
+                datagram, (source, _) = self._udpSocket.recvfrom(2048)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logging.error("UDP receive: %s", e)
+                break
+            if self._udpSource is not None and source != self._udpSource:
+                continue
+            reading = self._parseDatagram(datagram)
+            if reading is not None:
+                latest = reading
+        if latest is not None:
+            received = time.monotonic()
+            meter_data, energy_data = latest
+            if not self._pushActive:
+                logging.info("Receiving datagrams from %s, polling suspended", self._rpc.host)
+                self._pushActive = True
+            self._udpLast = received
+            self._connected = 1
+            self._failures = 0
+            self.stats.received()
+            self._publish(1, meter_data, energy_data)
+            self.stats.tick(time.monotonic() - received)
+
+    def _parseDatagram(self, datagram):
+        # The line printed by the script arrives in the Shelly's UDP debug log, after its own prefix
+        text = datagram.decode('utf-8', 'replace')
+        marker = text.find(UDP_MARKER)
+        if marker < 0:
+            return None
+        if self._payloads is not None:
+            self._payloads.add('udp', None, datagram)
+        try:
+            values = json.loads(text[marker + len(UDP_MARKER):])
+            if not isinstance(values, list) or len(values) != 2 + len(UDP_FIELDS):
+                raise ValueError("not a list of %d values" % (2 + len(UDP_FIELDS)))
+            # anything else than a number would go straight to D-Bus: a reading may only miss a value (null)
+            for index, value in enumerate(values):
+                if value is None and index >= 2:
+                    continue
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError("%.20r is not a number" % (value,))
+            session, sequence = values[0], int(values[1])
+        except (ValueError, TypeError, IndexError, KeyError) as e:
+            logging.error("Invalid datagram from %s: %s", self._rpc.host, e)
+            self.stats.invalid()
+            return None
+
+        self._udpReceived += 1
+        if session != self._udpSession:
+            # first datagram, or the script has been restarted: a new sequence begins
+            self._udpSession = session
+        else:
+            # 16 bit sequence number
+            step = (sequence - self._udpSequence) % 65536
+            if step == 0 or step > 32768:
+                # duplicate, or late: a newer one was applied already
+                self._udpReordered += 1
+                return None
+            self._udpLost += step - 1
+        self._udpSequence = sequence
+
+        meter_data = {'id': 0}
+        energy_data = {'id': 0}
+        for index, key in enumerate(UDP_FIELDS):
+            (meter_data if index < 9 else energy_data)[key] = values[2 + index]
+        return meter_data, energy_data
+
+    def _queueSample(self, sample):
+        # Only the latest sample is kept: if the main loop has not consumed the previous one yet,
+        # it is replaced instead of queued.
+        with self._sampleLock:
+            schedule = self._pendingSample is None
+            if not schedule:
+                self._droppedSamples += 1
+            self._pendingSample = sample
+        if schedule:
+            gobject.idle_add(self._applyPendingSample)
+
+    def _applyPendingSample(self):
+        with self._sampleLock:
+            sample = self._pendingSample
+            self._pendingSample = None
+        if sample is None:
+            return False
+
+        # started: beginning of the acquisition, fetched: answer of the Shelly (time.monotonic())
+        started, fetched, connected, meter_data, energy_data = sample
+        age = time.monotonic() - fetched
+        if age > 2 * self.interval:
+            self._droppedSamples += 1
+            logging.debug("Dropping stale sample (%.1fs old, %d dropped so far)", age, self._droppedSamples)
+            meter_data = energy_data = None
+        self._publish(connected, meter_data, energy_data)
+        if meter_data is not None and energy_data is not None:
+            self.stats.tick(time.monotonic() - started)
+
+        # one-shot idle callback
+        return False
+
+    def _update(self):
+        # get data from Shelly
+        started = time.monotonic()
+        meter_data, energy_data = self._fetchSample()
+        delay = self._nextPollDelay(meter_data)
+        self._publish(0 if self._failures else 1, meter_data, energy_data)
+        if meter_data is not None and energy_data is not None:
+            self.stats.tick(time.monotonic() - started)
+
+        # the interval changes from one request to the next: re-arm the timer and return False to drop this one
+        gobject.timeout_add(int(delay * 1000), self._update)
+        return False
+
+    def _publish(self, connected, meter_data, energy_data):
+        if self.history is not None and meter_data is not None:
+            now = time.time()
+            self.history.add(now, meter_data)
+            if self._smoothing:
+                meter_data = self.history.smoothed(meter_data, self._smoothing, now)
+
+        # one reading, every role takes its phase from it
+        for role in self.roles:
+            role.publishSample(connected, meter_data, energy_data)
+
+
+class DbusShellyEMService:
+    """D-Bus side: the Victron service of one role (pvinverter, grid or genset) fed from one phase of the meter."""
+
+    def __init__(self, role, servicename, paths, section, productid, serial=None, fwversion=None, connected=1,
+                 productname='Shelly Pro3EM', connection='Shelly EM RPC JSON service'):
+        self.role = role
+        self._section = section
+        deviceinstance = int(self._section['Deviceinstance'])
+        customname = self._section['CustomName']
+
+        self.servicename = "{}.http_{:02d}".format(servicename, deviceinstance)
+        self._plan, self._historyKeys, self._fixedValues = self._compilePlan(role, self._section)
+        self._bus = dbus_connection()
+        self._dbusservice = VeDbusService(self.servicename, bus=self._bus, register=False)
+        self._paths = paths
+
+        logging.debug("%s /DeviceInstance = %d", servicename, deviceinstance)
+        paths_wo_unit = [
+            '/Status',
+            '/Mode'
+        ]
+
+        # Create the management objects, as specified in the ccgx dbus-api document
+        self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
+        self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
+        self._dbusservice.add_path('/Mgmt/Connection', connection)
+
+        # Create the mandatory objects
+        self._dbusservice.add_path('/DeviceInstance', deviceinstance)
+        self._dbusservice.add_path('/ProductId', productid)
+        self._dbusservice.add_path('/ProductName', productname)
+        self._dbusservice.add_path('/CustomName', customname, writeable=False)
+        self._dbusservice.add_path('/Connected', connected, writeable=True)
+        self._dbusservice.add_path('/Latency', None)
+        self._dbusservice.add_path('/FirmwareVersion', 0.1)
+        self._dbusservice.add_path('/HardwareVersion', fwversion)
+        self._dbusservice.add_path('/Serial', serial)
+        self._dbusservice.add_path('/UpdateIndex', 0)
+        for path in DIAGNOSTIC_PATHS + HISTORY_PATHS:
+            self._dbusservice.add_path(path, None)
+        if role == 'PVINVERTER':
+            self._dbusservice.add_path('/Ac/MaxPower', 500.1, writeable=False, gettextcallback=lambda p, v: f"{v} W")
+            self._dbusservice.add_path('/Position', int(self._section.get('ACPosition', '1')))
+            self._dbusservice.add_path('/StatusCode', 8)  # Dummy path so VRM detects us as a PV-inverter.
+            # 0=Startup 0; 1=Startup 1; 2=Startup 2; 3=Startup 3; 4=Startup 4; 5=Startup 5; 6=Startup 6; 7=Running; 8=Standby; 9=Boot loading; 10=Error
+
+        # add paths without units
+        for path in paths_wo_unit:
+            self._dbusservice.add_path(path, None)
+
+        # add path values to dbus
+        for path, settings in self._paths.items():
+            self._dbusservice.add_path(
+                path, settings['initial'], gettextcallback=settings['textformat'], writeable=True,
+                onchangecallback=self._handlechangedvalue)
+        self._dbusservice.register()
+        # last update
+        self._lastUpdate = 0
+
+        # last value written on each path, and the change under which a new value is not worth a D-Bus signal
+        self._published = {}
+        self._updateIndex = 0
+        self._deadbands = self._compileDeadbands(self._section)
+        # recent velib: 'with service as s' sends all the changes of a tick in one ItemsChanged signal
+        self._batched = hasattr(self._dbusservice, '__enter__')
+
+    def _compileDeadbands(self, section):
+        deadbands = {}
+        names = [(path, path.rsplit('/', 1)[-1]) for path in self._paths] + [(path, path.split('/')[2]) for path in HISTORY_PATHS]
+        for path, name in names:
+            key = DEADBANDS.get(name)
+            if key is not None:
+                deadband = float(section.get(key, DEADBAND_DEFAULTS[key]))
+                if deadband > 0:
+                    deadbands[path] = deadband
+        return deadbands
+
+    @staticmethod
+    def _compilePlan(role, section):
+        # Validate the role section once and turn it into the list of copies a tick has to do, so an
+        # invalid config.ini stops the service at startup (or is refused by a reload) instead of failing
+        # every second. Returns the plan, the history keys and the fixed values.
+        source_phase = str(section['Phase']).upper()
+        valid_phases = {'A', 'B', 'C'}
+        if source_phase not in valid_phases:
+            raise ValueError(f"[{section.name}] Phase value '{source_phase}' is not valid. Must be one of {valid_phases | {'OFF'}}.")
+        destination_phase = str(section.get('PhaseDestination', 'L1')).upper()
+        valid_Dbus_phases = {'L1', 'L2', 'L3'}
+        if destination_phase not in valid_Dbus_phases:
+            raise ValueError(f"[{section.name}] PhaseDestination value '{destination_phase}' is not valid. Must be one of {valid_Dbus_phases}.")
+        invertpowersign = str(section.get('InvertPowerSign', '0'))
+        valid_invertpowersign = {'0', '1'}
+        if invertpowersign not in valid_invertpowersign:
+            raise ValueError(f"[{section.name}] InvertPowerSign value '{invertpowersign}' is not valid. Must be one of {valid_invertpowersign}.")
+        energy_type = str(section.get('EnergyType', 'direct')).lower()
+        valid_energy_types = {'direct', 'return'}
+        if energy_type not in valid_energy_types:
+            logging.warning("[%s] EnergyType value '%s' is not valid. Must be one of %s. Using 'direct' as default.",
+                            section.name, energy_type, valid_energy_types)
+            energy_type = 'direct'
+        numbers = sorted(set(DEADBANDS.values())) + (['ACPosition'] if role == 'PVINVERTER' else [])
+        for key in numbers:
+            try:
+                float(section.get(key, '0'))
+            except ValueError:
+                raise ValueError(f"[{section.name}] {key} value '{section[key]}' is not a number.")
+
+        src = source_phase.lower()
+        pre = '/Ac/' + destination_phase
+        sign = -1 if invertpowersign == '1' else 1
+        forward, reverse = f'{src}_total_act_energy', f'{src}_total_act_ret_energy'
+        if energy_type == 'return':
+            forward, reverse = reverse, forward
+
+        # (source: 0 = EM status, 1 = EMData status, Shelly key, D-Bus paths, scale, values written when the key is missing)
+        plan = (
+            (0, f'{src}_voltage', (pre + '/Voltage',), 1, {}),
+            (0, f'{src}_current', (pre + '/Current',), sign, {}),
+            (0, f'{src}_act_power', (pre + '/Power', '/Ac/Power'), sign, {}),
+            (1, forward, (pre + '/Energy/Forward', '/Ac/Energy/Forward'), 0.001, {pre + '/Energy/Forward': 0}),
+            (1, reverse, (pre + '/Energy/Reverse', '/Ac/Energy/Reverse'), 0.001, {pre + '/Energy/Reverse': 0}),
+        )
+
+        # keys and sign of the aggregates published under /History
+        history_keys = (('Power', f'{src}_act_power', sign), ('Voltage', f'{src}_voltage', 1), ('Current', f'{src}_current', sign))
+
+        # values that do not depend on the reading: the unused phases, the state
+        fixed_values = {'/Mode': 0}  # Manual, no control
+        if role == 'PVINVERTER':
+            fixed_values['/StatusCode'] = 7  # Running
+        for phase in valid_Dbus_phases - {destination_phase}:
+            for name in ('/Voltage', '/Current', '/Power', '/Energy/Forward', '/Energy/Reverse'):
+                fixed_values['/Ac/' + phase + name] = None
+        return plan, history_keys, fixed_values
+
+    def reconfigure(self, section, plan):
+        """Switch to a new role section of config.ini and its plan from _compilePlan(), between two readings."""
+        deadbands = self._compileDeadbands(section)
+        self._section = section
+        self._plan, self._historyKeys, self._fixedValues = plan
+        self._deadbands = deadbands
+        # the next reading writes every path again, with the new phase mapping and sign
+        self._published.clear()
+        values = {'/CustomName': section['CustomName']}
+        if self.role == 'PVINVERTER':
+            values['/Position'] = int(section.get('ACPosition', '1'))
+        self.publishValues(values, index=False)
+
+    def unregister(self):
+        # velib releases the bus name and the object paths of a service on an explicit __del__()
+        self._dbusservice.__del__()
+        self._bus.close()
+
+    def publishSample(self, connected, meter_data=None, energy_data=None):
+        try:
+            values = {'/Connected': connected}
             if meter_data is None or energy_data is None:
-                return True  
-
-            for key, value in meter_data.items():
-                logging.debug("_update meter_data['%s'] : %s", key, value)
-
-            source_phase = str(self.config['PVINVERTER']['Phase'])
-            valid_phases = {'A', 'B', 'C', 'OFF'}
-            if source_phase not in valid_phases:
-                raise ValueError(f"Phase value '{source_phase}' is not valid. Must be one of {valid_phases}.")
-            pvinverter_phase = str(self.config['PVINVERTER']['PhaseDestination'])
-            valid_Dbus_phases = {'L1', 'L2', 'L3'}
-            if pvinverter_phase not in valid_Dbus_phases:
-                raise ValueError(f"PhaseDestination value '{pvinverter_phase}' is not valid. Must be one of {valid_Dbus_phases}.")
-            invertpowersign = str(self.config['PVINVERTER']['InvertPowerSign'])
-            valid_invertpowersign = {'0', '1'}
-            if invertpowersign not in valid_invertpowersign:
-                raise ValueError(f"InvertPowerSign value '{invertpowersign}' is not valid. Must be one of {valid_invertpowersign}.")
-
-            energy_type = str(self.config['PVINVERTER'].get('EnergyType', 'direct')).lower()
-            valid_energy_types = {'direct', 'return'}
-            if energy_type not in valid_energy_types:
-                logging.warning(f"EnergyType value '{energy_type}' is not valid. Must be one of {valid_energy_types}. Using 'direct' as default.")
-                energy_type = 'direct'
-
-            if pvinverter_phase != 'OFF':
-                # send data to DBus
-
-                for phase in ['L1', 'L2', 'L3']:
-                    pre = '/Ac/' + phase
-
-                    self._dbusservice['/StatusCode'] = 7  # Running
-
-                    if phase == pvinverter_phase:
-                        power = meter_data.get(f'{source_phase.lower()}_act_power')
-                        voltage = meter_data.get(f'{source_phase.lower()}_voltage')
-                        current = meter_data.get(f'{source_phase.lower()}_current')
-
-                        if power is None or voltage is None or current is None:
-                            logging.error(f"Missing data for phase {source_phase}. Skipping update.")
-                            continue 
-
-                        if invertpowersign == '1':
-                            power = -power
-                            current = -current
-
-                        self._dbusservice[pre + '/Voltage'] = voltage
-                        self._dbusservice[pre + '/Current'] = current
-                        self._dbusservice[pre + '/Power'] = power
-                        self._dbusservice['/Ac/Power'] = power
-                        
-
-                        for keyenergy_data, valueenergy_data in energy_data.items():
-                                logging.debug("_update energy_data['%s'] : %s", keyenergy_data, valueenergy_data)
-                        if energy_data is not None:
-                            if energy_type == 'direct':
-                                energy_key = f"{source_phase.lower()}_total_act_energy"
-                                energy_reverse_key = f"{source_phase.lower()}_total_act_ret_energy"
-                            else:
-                                energy_key = f"{source_phase.lower()}_total_act_ret_energy"
-                                energy_reverse_key = f"{source_phase.lower()}_total_act_energy"
-                            logging.debug("_energy_key : %s", energy_key)
-                            logging.debug("energy_reverse_key : %s", energy_reverse_key)
-                            energy_value = energy_data.get(energy_key)
-                            energy_reverse_value = energy_data.get(energy_reverse_key)
-                            logging.debug("_energy_value : %s", energy_value)
-                            logging.debug("_energy_reverse_value: %s", energy_reverse_value)
-                            
-                            if energy_value is not None:
-                                self._dbusservice[pre + '/Energy/Forward'] = energy_value / 1000
-                                self._dbusservice['/Ac/Energy/Forward'] = energy_value / 1000
-                            else:
-                                logging.error(f"Missing energy data for key {energy_key}.")
-                                self._dbusservice[pre + '/Energy/Forward'] = 0
-
-                            if energy_reverse_value is not None:
-                                self._dbusservice[pre + '/Energy/Reverse'] = energy_reverse_value / 1000  
-                                self._dbusservice['/Ac/Energy/Reverse'] = energy_reverse_value / 1000
-                            else:
-                                logging.error(f"Missing reverse energy data for key {energy_reverse_key}.")
-                                self._dbusservice[pre + '/Energy/Reverse'] = 0
-
-
-
-                    else:
-                        self._dbusservice[pre + '/Voltage'] = None
-                        self._dbusservice[pre + '/Current'] = None
-                        self._dbusservice[pre + '/Power'] = None
-                        self._dbusservice[pre + '/Energy/Forward'] = None
-                        self._dbusservice[pre + '/Energy/Reverse'] = None
-                        
-
-
-            # increment UpdateIndex - to show that new data is available
-            index = self._dbusservice['/UpdateIndex'] + 1  # increment index
-            if index > 255:  # maximum value of the index
-                index = 0  # overflow from 255 to 0
-            self._dbusservice['/UpdateIndex'] = index
-            self._dbusservice['/Mode'] = 0  # Manual, no control
+                self.publishValues(values)
+                return
+
+            values.update(self._fixedValues)
+            data = (meter_data, energy_data)
+            for source, key, paths, scale, missing in self._plan:
+                value = data[source].get(key)
+                if value is None:
+                    logging.error("Missing %s in the Shelly data.", key)
+                    values.update(missing)
+                    continue
+                value *= scale
+                for path in paths:
+                    values[path] = value
+            self.publishValues(values)
 
             # update lastupdate vars
             self._lastUpdate = time.time()
         except Exception as e:
-            logging.critical('Error at %s', '_update', exc_info=e)
-
-        # return true, otherwise add_timeout will be removed from GObject - see docs http://library.isr.ist.utl.pt/docs/pygtk2reference/gobject-functions.html#function-gobject--timeout-add
-        return True
+            logging.critical('Error at %s', 'publishSample', exc_info=e)
+
+    def publishHistory(self, history, now):
+        values = {}
+        for quantity, key, sign in self._historyKeys:
+            for name, seconds in HISTORY_WINDOWS:
+                window = history.window(key, seconds, now)
+                if window is None:
+                    low = high = mean = None
+                elif sign < 0:
+                    low, high, mean = -window[1], -window[0], -window[2]
+                else:
+                    low, high, mean = window
+                pre = '/History/%s/%s/' % (quantity, name)
+                values[pre + 'Min'] = low
+                values[pre + 'Max'] = high
+                values[pre + 'Mean'] = mean
+        self.publishValues(values, index=False)
+
+    def publishValues(self, values, index=True):
+        # Only the values that moved by more than the deadband of their path are written, and all of
+        # them in a single ItemsChanged signal when velib supports it. index=False leaves /UpdateIndex
+        # alone, for values that are not part of a reading.
+        changes = {}
+        for path, value in values.items():
+            if path in self._published:
+                last = self._published[path]
+                if value == last:
+                    continue
+                deadband = self._deadbands.get(path)
+                if deadband and value is not None and last is not None and abs(value - last) < deadband:
+                    continue
+            changes[path] = value
+        if not changes:
+            return
+
+        # increment UpdateIndex - to show that new data is available
+        if index:
+            self._updateIndex = (self._updateIndex + 1) % 256  # overflow from 255 to 0
+            changes['/UpdateIndex'] = self._updateIndex
+        if self._batched:
+            with self._dbusservice as service:
+                for path, value in changes.items():
+                    service[path] = value
+        else:
+            for path, value in changes.items():
+                self._dbusservice[path] = value
+        self._published.update(changes)
 
     def _handlechangedvalue(self, path, value):
-        logging.debug("someone else updated %s to %s" % (path, value))
+        logging.debug("someone else updated %s to %s", path, value)
+        # written by someone else: publish our next value whatever the deadband
+        self._published.pop(path, None)
 
         return True  # accept the change
 
@@ -366,7 +1920,6 @@ def get_log_level(config):
     # Convertir en majuscules pour l'insensibilité à la casse
     log_level_str = log_level_str.upper()
 
-    print(f"Started with log level : '{log_level_str}'")
     return log_levels.get(log_level_str, logging.ERROR)
 
 
@@ -376,8 +1929,10 @@ def main():
     log_directory = os.path.dirname(os.path.realpath(__file__))
     log_file = os.path.join(log_directory, "current.log")
     config = configparser.ConfigParser()
-    config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
+    config_file = "%s/config.ini" % (os.path.dirname(os.path.realpath(__file__)))
+    config.read(config_file)
     log_level = get_log_level(config)
+    print(f"Started with log level : '{logging.getLevelName(log_level)}'")
 
     logging.basicConfig(
         format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
@@ -388,6 +1943,13 @@ def main():
             logging.StreamHandler()
         ])
 
+    # the same message over and over (a meter offline, a missing key) is logged once per window
+    repeat_window = float(config.get('DEFAULT', 'Log_RepeatWindow', fallback='60'))
+    repeat_filter = None
+    if repeat_window > 0:
+        repeat_filter = RepeatFilter(repeat_window)
+        logging.getLogger().addFilter(repeat_filter)
+
     try:
         logging.info("Log level set to %s", logging.getLevelName(log_level))
         logging.info("Start shelly reading")
@@ -402,35 +1964,69 @@ def main():
         _w = lambda p, v: (str(round(v, 1)) + 'W')
         _v = lambda p, v: (str(round(v, 1)) + 'V')
 
-        # start our main-service
-        pvac_output = DbusShellyEMService(
-            servicename='com.victronenergy.pvinverter',
-            paths={
-                '/Ac/Energy/Forward': {'initial': None, 'textformat': _kwh},  # energy produced by pv inverter
-                '/Ac/Energy/Reverse': {'initial': None, 'textformat': _kwh},  # energy produced by pv inverter
-                '/Ac/Power': {'initial': 0, 'textformat': _w},
-
-                '/Ac/Current': {'initial': 0, 'textformat': _a},
-                '/Ac/Voltage': {'initial': 0, 'textformat': _v},
-                '/SetCurrent': {'initial': 0, 'textformat': _a},
-                '/StartStop': {'initial': 0, 'textformat': lambda p, v: (str(v))},
-                '/Ac/L1/Voltage': {'initial': None, 'textformat': _v},
-                '/Ac/L2/Voltage': {'initial': None, 'textformat': _v},
-                '/Ac/L3/Voltage': {'initial': None, 'textformat': _v},
-                '/Ac/L1/Current': {'initial': None, 'textformat': _a},
-                '/Ac/L2/Current': {'initial': None, 'textformat': _a},
-                '/Ac/L3/Current': {'initial': None, 'textformat': _a},
-                '/Ac/L1/Power': {'initial': None, 'textformat': _w},
-                '/Ac/L2/Power': {'initial': None, 'textformat': _w},
-                '/Ac/L3/Power': {'initial': None, 'textformat': _w},
-                '/Ac/L1/Energy/Forward': {'initial': None, 'textformat': _kwh},
-                '/Ac/L2/Energy/Forward': {'initial': None, 'textformat': _kwh},
-                '/Ac/L3/Energy/Forward': {'initial': None, 'textformat': _kwh},
-                '/Ac/L1/Energy/Reverse': {'initial': None, 'textformat': _kwh},
-                '/Ac/L2/Energy/Reverse': {'initial': None, 'textformat': _kwh},
-                '/Ac/L3/Energy/Reverse': {'initial': None, 'textformat': _kwh},
-
-            })
+        paths = {
+            '/Ac/Energy/Forward': {'initial': None, 'textformat': _kwh},  # energy produced by pv inverter
+            '/Ac/Energy/Reverse': {'initial': None, 'textformat': _kwh},  # energy produced by pv inverter
+            '/Ac/Power': {'initial': 0, 'textformat': _w},
+
+            '/Ac/Current': {'initial': 0, 'textformat': _a},
+            '/Ac/Voltage': {'initial': 0, 'textformat': _v},
+            '/Ac/L1/Voltage': {'initial': None, 'textformat': _v},
+            '/Ac/L2/Voltage': {'initial': None, 'textformat': _v},
+            '/Ac/L3/Voltage': {'initial': None, 'textformat': _v},
+            '/Ac/L1/Current': {'initial': None, 'textformat': _a},
+            '/Ac/L2/Current': {'initial': None, 'textformat': _a},
+            '/Ac/L3/Current': {'initial': None, 'textformat': _a},
+            '/Ac/L1/Power': {'initial': None, 'textformat': _w},
+            '/Ac/L2/Power': {'initial': None, 'textformat': _w},
+            '/Ac/L3/Power': {'initial': None, 'textformat': _w},
+            '/Ac/L1/Energy/Forward': {'initial': None, 'textformat': _kwh},
+            '/Ac/L2/Energy/Forward': {'initial': None, 'textformat': _kwh},
+            '/Ac/L3/Energy/Forward': {'initial': None, 'textformat': _kwh},
+            '/Ac/L1/Energy/Reverse': {'initial': None, 'textformat': _kwh},
+            '/Ac/L2/Energy/Reverse': {'initial': None, 'textformat': _kwh},
+            '/Ac/L3/Energy/Reverse': {'initial': None, 'textformat': _kwh},
+        }
+        pvinverter_paths = dict(paths)
+        pvinverter_paths.update({
+            '/SetCurrent': {'initial': 0, 'textformat': _a},
+            '/StartStop': {'initial': 0, 'textformat': lambda p, v: (str(v))},
+        })
+
+        # start our main-service: one poll of a meter feeds the service of every enabled role,
+        # each [SHELLY_CONNECTION:<name>] section adds a meter
+        names = meter_names(config)
+        check_service_names(config, names)
+        check_udp_ports(config, names)
+
+        meters = [ShellyPro3EM(config, paths={'PVINVERTER': pvinverter_paths, 'GRID': paths, 'GENSET': paths}, name=name)
+                  for name in names]
+
+        age = process_age()
+        if age is not None:
+            logging.info("%d D-Bus services registered %.0f ms after launch",
+                         sum(len(meter.roles) for meter in meters), age * 1000)
+
+        threaded = [meter for meter in meters if meter.pollMode == 'thread']
+        if threaded:
+            scheduler = PollScheduler(threaded)
+
+        if repeat_filter is not None:
+            gobject.timeout_add(int(repeat_window * 1000), repeat_filter.flush)
+
+        # kill -USR1 <pid> writes the last answers of every meter to payloads_<host>.log
+        def dump_payloads():
+            for meter in meters:
+                meter.dumpPayloads("SIGUSR1")
+            return True
+        gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR1, dump_payloads)
+
+        # config.ini is applied again when it changes
+        def config_changed():
+            nonlocal names
+            names = reload_config(config_file, meters, names)
+        if config.get('DEFAULT', 'ConfigReload', fallback='1') == '1':
+            config_watcher = ConfigWatcher(config_file, config_changed)
 
         logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
         mainloop = gobject.MainLoop()
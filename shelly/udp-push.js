@@ -0,0 +1,49 @@
+// ─────────────────────────────────────────────────────────────────────────────
+// Project: dbus-shelly-pro-3em-smartmeter
+// Source: https://github.com/f5uii/dbus-shelly-pro-3em-smartmeter
+//
+// Shelly Pro 3EM script for Ingest = udp: sends every new reading of the meter
+// to the GX, without any request from the GX.
+//
+// Shelly scripts cannot open a UDP socket, so the readings are printed and
+// reach the GX through the UDP debug log of the Shelly, which this script
+// points at the GX. Each reading is one line:
+//
+//   P3EM [session, sequence, a_voltage, a_current, a_act_power, b_..., c_...,
+//         a_total_act_energy, a_total_act_ret_energy, b_..., c_...]
+//
+// Install: Shelly web UI > Scripts > Add script, paste this file, set GX below
+// to the address of the GX and the UdpPort of config.ini, save, start, and
+// enable "Run on startup".
+// ─────────────────────────────────────────────────────────────────────────────
+
+let GX = "192.168.1.20:5600";
+
+// changes when the script restarts, the GX then expects a new sequence
+let session = Math.floor(Shelly.getComponentStatus("sys").uptime);
+let sequence = 0;
+
+function send() {
+  let em = Shelly.getComponentStatus("em", 0);
+  let data = Shelly.getComponentStatus("emdata", 0);
+  if (em === null || data === null) {
+    return;
+  }
+  sequence = (sequence + 1) % 65536;
+  print("P3EM " + JSON.stringify([session, sequence,
+    em.a_voltage, em.a_current, em.a_act_power,
+    em.b_voltage, em.b_current, em.b_act_power,
+    em.c_voltage, em.c_current, em.c_act_power,
+    data.a_total_act_energy, data.a_total_act_ret_energy,
+    data.b_total_act_energy, data.b_total_act_ret_energy,
+    data.c_total_act_energy, data.c_total_act_ret_energy]));
+}
+
+Shelly.call("Sys.SetConfig", {config: {debug: {udp: {addr: GX}}}});
+
+// the em:0 status changes with every measurement of the meter
+Shelly.addStatusHandler(function (event) {
+  if (event.component === "em:0") {
+    send();
+  }
+});
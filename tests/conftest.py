@@ -0,0 +1,95 @@
+# Fixtures shared by the tests: the service loaded with the stubs of bench/stubs in place of vedbus and
+# GLib (see bench/harness.py), and bench/fake_shelly.py running in this process.
+
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'bench'))
+import fake_shelly  # noqa: E402
+import harness  # noqa: E402
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(name='free_port')
+def free_port_fixture():
+    """free_port(kind=socket.SOCK_STREAM): a port nothing listens on."""
+    return free_port
+
+
+@pytest.fixture(scope='session')
+def driver(tmp_path_factory):
+    driver = harness.load_driver()
+    # the payload dumps and the device cache are written next to the service, not in the repository
+    files = tmp_path_factory.mktemp('driver')
+    driver.PAYLOAD_DUMP_FILE = str(files / 'payloads_%s.log')
+    driver.DEVICE_CACHE_FILE = str(files / 'device_cache.json')
+    return driver
+
+
+@pytest.fixture
+def role_paths():
+    paths = harness.paths()
+    return {'PVINVERTER': paths, 'GRID': paths, 'GENSET': paths}
+
+
+@pytest.fixture
+def shelly():
+    """Start a stand-in with fake_shelly command line options, e.g. shelly('--password', 'secret').
+    Returns its HTTP server, with server.host for config.ini and server.RequestHandlerClass.meter."""
+    servers = []
+
+    def start(*options):
+        server = fake_shelly.serve(fake_shelly.parse_args(['--port', '0'] + list(options)))
+        server.host = '%s:%d' % server.server_address
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def make_meter(driver, role_paths, monkeypatch, tmp_path):
+    """Build a ShellyPro3EM from the config.ini of the repository with {'SECTION': {'Key': 'value'}} overrides.
+    Its payload dumps and device cache go to tmp_path."""
+    monkeypatch.setattr(driver, 'PAYLOAD_DUMP_FILE', str(tmp_path / 'payloads_%s.log'))
+    monkeypatch.setattr(driver, 'DEVICE_CACHE_FILE', str(tmp_path / 'device_cache.json'))
+    meters = []
+
+    def make(**overrides):
+        meter = driver.ShellyPro3EM(harness.load_config(**overrides), paths=role_paths)
+        meters.append(meter)
+        return meter
+    yield make
+    for meter in meters:
+        if meter.pollMode == 'thread':
+            meter._pollStop.set()
+        if getattr(meter, '_udpSocket', None) is not None:
+            meter._udpSocket.close()
+        meter._client.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+@pytest.fixture(name='wait_for')
+def wait_for_fixture():
+    """wait_for(condition, timeout=5): poll condition() until it is true, fail after timeout seconds."""
+    return wait_for
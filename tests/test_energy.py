@@ -0,0 +1,36 @@
+POWER = {'a_act_power': 3600.0, 'b_act_power': 0.0, 'c_act_power': 0.0}
+
+
+def energy(a):
+    data = {key: 0.0 for key in ('a_total_act_energy', 'a_total_act_ret_energy', 'b_total_act_energy',
+                                 'b_total_act_ret_energy', 'c_total_act_energy', 'c_total_act_ret_energy')}
+    data['a_total_act_energy'] = a
+    return data
+
+
+def tiered_meter(make_meter):
+    return make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'EnergyInterval': '60', 'History': '0', 'PayloadBuffer': '0'})
+
+
+def test_estimate_between_two_readings(make_meter):
+    meter = tiered_meter(make_meter)
+    assert meter._anchorEnergy(POWER, energy(1000.0), 0)['a_total_act_energy'] == 1000.0
+    # 3600 W for 10 s
+    assert meter._integrateEnergy(POWER, 10)['a_total_act_energy'] == 1010.0
+
+
+def test_estimate_ahead_of_the_reading_is_held(make_meter):
+    meter = tiered_meter(make_meter)
+    meter._anchorEnergy(POWER, energy(1000.0), 0)
+    meter._integrateEnergy(POWER, 10)
+    # the meter counted a little less than the estimate: the counter does not go back
+    assert meter._anchorEnergy(POWER, energy(1008.0), 10)['a_total_act_energy'] == 1010.0
+    assert meter._anchorEnergy(POWER, energy(1012.0), 20)['a_total_act_energy'] == 1012.0
+
+
+def test_counter_reset_on_the_shelly_is_followed(make_meter):
+    meter = tiered_meter(make_meter)
+    meter._anchorEnergy(POWER, energy(500000.0), 0)
+    meter._integrateEnergy(POWER, 10)
+    assert meter._anchorEnergy(POWER, energy(10.0), 20)['a_total_act_energy'] == 10.0
+    assert meter._integrateEnergy(POWER, 30)['a_total_act_energy'] == 20.0
@@ -0,0 +1,89 @@
+import gc
+
+import pytest
+
+START = 900 * 2000  # a multiple of every period of HISTORY_LEVELS
+
+
+def reading(value):
+    return {key: value for key in ('%s_%s' % (phase, name) for phase in 'abc' for name in ('voltage', 'current', 'act_power'))}
+
+
+def fill(history, times):
+    for now in times:
+        history.add(now, reading(float(now)))
+
+
+def expected(times, period, seconds):
+    # (min, max, mean) of the readings in the buckets that start after the last reading - seconds
+    values = [time for time in times if time - time % period > times[-1] - seconds]
+    return min(values), max(values), sum(values) / len(values)
+
+
+def test_one_minute_window_covers_sixty_buckets(driver):
+    history = driver.SampleHistory()
+    fill(history, range(START, START + 101))
+    low, high, mean = history.window('a_act_power', 60, START + 100)
+    assert (low, high) == (START + 41, START + 100)
+    assert mean == START + 70.5
+
+
+@pytest.mark.parametrize('name, seconds, period', [('1m', 60, 1), ('15m', 900, 60), ('24h', 86400, 900)])
+def test_each_window_is_read_from_its_level(driver, name, seconds, period):
+    # a reading every 30 s for two days, whatever the window they all go through the three levels
+    times = list(range(START, START + 2 * 86400 + 1, 30))
+    history = driver.SampleHistory()
+    fill(history, times)
+    assert (name, seconds) in driver.HISTORY_WINDOWS
+    assert history.window('b_current', seconds, times[-1]) == pytest.approx(expected(times, period, seconds))
+
+
+def test_rings_wrap_around(driver):
+    # 700 s of readings: the raw ring (256) and the 1 s buckets (600) have both gone round
+    times = list(range(START, START + 700))
+    history = driver.SampleHistory()
+    fill(history, times)
+    now = times[-1]
+    assert history.window('c_voltage', 60, now) == pytest.approx((now - 59, now, now - 29.5))
+    assert history.smoothed({}, 9.5, now)['c_voltage'] == pytest.approx(now - 4.5)
+    # nothing older than the oldest bucket is left
+    assert history.window('c_voltage', 600, now) == pytest.approx((now - 599, now, now - 299.5))
+
+
+def test_old_readings_leave_the_window(driver):
+    history = driver.SampleHistory()
+    fill(history, range(START, START + 10))
+    assert history.window('a_voltage', 60, START + 200) is None
+
+
+def test_history_file_survives_a_restart(driver, tmp_path):
+    path = str(tmp_path / 'history')
+    times = list(range(START, START + 3600, 5))
+    history = driver.SampleHistory(path)
+    fill(history, times)
+    windows = [history.window('a_act_power', seconds, times[-1]) for _, seconds in driver.HISTORY_WINDOWS]
+    del history
+    gc.collect()
+
+    history = driver.SampleHistory(path)
+    assert [history.window('a_act_power', seconds, times[-1]) for _, seconds in driver.HISTORY_WINDOWS] == windows
+    history.add(times[-1] + 5, reading(0.0))
+    assert history.window('a_act_power', 60, times[-1] + 5)[0] == 0.0
+
+
+@pytest.mark.parametrize('setting, value', [('HISTORY_RAW_SIZE', 128), ('HISTORY_LEVELS', ((2, 600), (60, 240), (900, 672)))])
+def test_history_file_of_another_layout_is_reset(driver, monkeypatch, tmp_path, setting, value):
+    # a file written with other sizes, or with the same size and other periods
+    path = str(tmp_path / 'history')
+    with monkeypatch.context() as patch:
+        patch.setattr(driver, setting, value)
+        history = driver.SampleHistory(path)
+        fill(history, range(START, START + 100))
+        assert history.window('a_act_power', 60, START + 99) is not None
+        del history
+        gc.collect()
+
+    history = driver.SampleHistory(path)
+    for _, seconds in driver.HISTORY_WINDOWS:
+        assert history.window('a_act_power', seconds, START + 99) is None
+    assert history.smoothed({'a_act_power': 1.0}, 60, START + 99) == {'a_act_power': 1.0}
@@ -0,0 +1,33 @@
+import logging
+
+
+def record(message, *args, lineno=10):
+    return logging.LogRecord('root', logging.ERROR, '/driver.py', lineno, message, args, None)
+
+
+def test_connection_errors_differing_by_address_are_counted(driver):
+    repeat = driver.RepeatFilter(60)
+    error = "HTTPConnectionPool(host='10.0.0.5', port=80): Max retries exceeded (Caused by " \
+            "NewConnectionError('<urllib3.connection.HTTPConnection object at %s>: Failed to establish a new connection'))"
+    assert repeat.filter(record("Shelly.GetStatus of %s: %s", '10.0.0.5', error % '0x7f3a1c2b5d90'))
+    assert not repeat.filter(record("Shelly.GetStatus of %s: %s", '10.0.0.5', error % '0x7f3a1c2b6e10'))
+    # another meter is another message
+    assert repeat.filter(record("Shelly.GetStatus of %s: %s", '10.0.0.6', error % '0x7f3a1c2b6e10'))
+
+
+def test_same_text_from_another_line_is_logged(driver):
+    repeat = driver.RepeatFilter(60)
+    assert repeat.filter(record("Shelly %s does not answer", '10.0.0.5', lineno=10))
+    assert repeat.filter(record("Shelly %s does not answer", '10.0.0.5', lineno=20))
+
+
+def test_count_is_appended_after_the_window(driver, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(driver.time, 'monotonic', lambda: clock[0])
+    repeat = driver.RepeatFilter(60)
+    for _ in range(3):
+        repeat.filter(record("Shelly %s does not answer", '10.0.0.5'))
+    clock[0] += 61
+    again = record("Shelly %s does not answer", '10.0.0.5')
+    assert repeat.filter(again)
+    assert again.getMessage() == "Shelly 10.0.0.5 does not answer (same message x3 in 61 s)"
@@ -0,0 +1,79 @@
+import harness
+import pytest
+
+METER = {'a_voltage': 230.0, 'a_current': 2.0, 'a_act_power': 460.0}
+ENERGY = {'a_total_act_energy': 1000.0, 'a_total_act_ret_energy': 10.0}
+
+
+@pytest.fixture
+def role(driver, role_paths):
+    config = harness.load_config(PVINVERTER={'Phase': 'A', 'Deadband_Power': '1', 'Deadband_Voltage': '0.1'})
+    role = driver.DbusShellyEMService('PVINVERTER', 'com.victronenergy.pvinverter', role_paths['PVINVERTER'],
+                                      config['PVINVERTER'], productid=0xA144)
+    yield role
+    role.unregister()
+
+
+def test_unchanged_values_are_not_written(role):
+    service = role._dbusservice
+    role.publishValues({'/Ac/Power': 100.0})
+    writes, index = service.writes, service['/UpdateIndex']
+    role.publishValues({'/Ac/Power': 100.0})
+    assert service.writes == writes
+    assert service['/UpdateIndex'] == index
+
+
+def test_changes_inside_the_deadband_are_skipped(role):
+    service = role._dbusservice
+    role.publishValues({'/Ac/Power': 100.0, '/Ac/L1/Voltage': 230.0})
+    writes = service.writes
+    role.publishValues({'/Ac/Power': 100.6, '/Ac/L1/Voltage': 230.05})
+    assert service.writes == writes and service['/Ac/Power'] == 100.0
+    # measured from the last published value, not from the last reading
+    role.publishValues({'/Ac/Power': 101.2, '/Ac/L1/Voltage': 230.05})
+    assert service['/Ac/Power'] == 101.2 and service['/Ac/L1/Voltage'] == 230.0
+    # None and back are always written
+    role.publishValues({'/Ac/Power': None})
+    assert service['/Ac/Power'] is None
+
+
+def test_one_reading_is_one_signal(role):
+    service = role._dbusservice
+    signals = service.signals
+    role.publishSample(1, METER, ENERGY)
+    assert service.signals == signals + 1
+    assert service.writes > 5
+    assert service['/Ac/L1/Power'] == 460.0 and service['/Ac/Energy/Forward'] == 1.0
+
+
+def test_update_index_only_moves_with_a_change(role):
+    service = role._dbusservice
+    role.publishSample(1, METER, ENERGY)
+    index = service['/UpdateIndex']
+    role.publishSample(1, METER, ENERGY)
+    assert service['/UpdateIndex'] == index
+    role.publishSample(1, dict(METER, a_act_power=470.0), ENERGY)
+    assert service['/UpdateIndex'] == (index + 1) % 256
+    # values that are not part of a reading leave it alone
+    role.publishValues({'/Diagnostics/Requests': 5}, index=False)
+    assert service['/UpdateIndex'] == (index + 1) % 256
+
+
+def test_value_written_by_someone_else_is_published_again(role):
+    service = role._dbusservice
+    role.publishValues({'/Ac/Power': 100.0})
+    service.values['/Ac/Power'] = 0
+    assert role._handlechangedvalue('/Ac/Power', 0)
+    role.publishValues({'/Ac/Power': 100.0})
+    assert service['/Ac/Power'] == 100.0
+
+
+def test_deadbands_default_to_the_documented_values(driver, role_paths):
+    config = harness.load_config(PVINVERTER={'Phase': 'A'})
+    for key in ('Deadband_Power', 'Deadband_Voltage', 'Deadband_Current', 'Deadband_Energy'):
+        config.remove_option('DEFAULT', key)
+    role = driver.DbusShellyEMService('PVINVERTER', 'com.victronenergy.pvinverter', role_paths['PVINVERTER'],
+                                      config['PVINVERTER'], productid=0xA144)
+    assert role._deadbands['/Ac/Power'] == 1 and role._deadbands['/Ac/L1/Voltage'] == 0.1
+    assert role._deadbands['/Ac/L1/Current'] == 0.01 and role._deadbands['/Ac/Energy/Forward'] == 0.01
+    role.unregister()
@@ -0,0 +1,115 @@
+import logging
+import os
+
+import harness
+import pytest
+
+CONNECTION = {'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'}
+EM = {'a_voltage': 230.0, 'a_current': 1.0, 'a_act_power': 100.0, 'b_voltage': 231.0, 'b_current': 2.0, 'b_act_power': 200.0,
+      'c_voltage': 232.0, 'c_current': 3.0, 'c_act_power': 300.0}
+EMDATA = {'%s_total_act%s_energy' % (phase, kind): 1000.0 for phase in 'abc' for kind in ('', '_ret')}
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    """write(**overrides): config.ini of the repository with overrides, written where reload_config() reads it."""
+    path = str(tmp_path / 'config.ini')
+
+    def write(**overrides):
+        with open(path, 'w') as file:
+            harness.load_config(**overrides).write(file)
+        return path
+    return write
+
+
+@pytest.fixture(autouse=True)
+def log_level():
+    # reload_config() sets the level of config.ini
+    level = logging.getLogger().level
+    yield
+    logging.getLogger().setLevel(level)
+
+
+def test_phase_and_sign_change_keep_the_service(driver, make_meter, config_file):
+    meter = make_meter(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'})
+    role = meter.roles[0]
+    service = role._dbusservice
+    role.publishSample(1, EM, EMDATA)
+    assert service['/Ac/Power'] == 100.0
+
+    path = config_file(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'B', 'InvertPowerSign': '1', 'CustomName': 'Roof'})
+    assert driver.reload_config(path, [meter], ['']) == ['']
+    assert meter.roles == [role] and role._dbusservice is service and service.registered
+    assert service['/CustomName'] == 'Roof'
+    role.publishSample(1, EM, EMDATA)
+    assert service['/Ac/Power'] == -200.0 and service['/Ac/L1/Voltage'] == 231.0
+
+
+def test_deviceinstance_change_registers_that_role_only(driver, make_meter, config_file):
+    meter = make_meter(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'}, GRID={'Phase': 'B'})
+    pvinverter, grid = meter.roles
+    path = config_file(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'}, GRID={'Phase': 'B', 'Deviceinstance': '52'})
+    driver.reload_config(path, [meter], [''])
+    assert meter.roles[0] is pvinverter and pvinverter._bus.paths
+    assert meter.roles[1] is not grid and meter.roles[1].servicename == 'com.victronenergy.grid.http_52'
+    assert not grid._bus.paths
+
+
+def test_disabled_role_is_registered(driver, make_meter, config_file):
+    meter = make_meter(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'})
+    pvinverter, = meter.roles
+    path = config_file(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'}, GENSET={'Phase': 'C'})
+    driver.reload_config(path, [meter], [''])
+    assert [role.role for role in meter.roles] == ['PVINVERTER', 'GENSET']
+    assert meter.roles[0] is pvinverter
+    assert meter.roles[1]._dbusservice.registered
+
+
+@pytest.mark.parametrize('overrides', [
+    {'PVINVERTER': {'Phase': 'D'}},
+    {'SHELLY_CONNECTION': {'MinInterval': 'fast'}},
+    {'PVINVERTER': {'Deadband_Power': 'none'}},
+    {'GRID': {'Phase': 'C', 'Deviceinstance': 'forty'}},
+])
+def test_invalid_file_changes_nothing(driver, make_meter, config_file, overrides):
+    meter = make_meter(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'})
+    role = meter.roles[0]
+    plan, timings = role._plan, (meter._minInterval, meter._maxInterval)
+    overrides = dict({'SHELLY_CONNECTION': CONNECTION, 'PVINVERTER': {'Phase': 'B'}}, **overrides)
+    path = config_file(**overrides)
+    assert driver.reload_config(path, [meter], ['']) == ['']
+    assert meter.roles == [role] and role._plan is plan
+    assert (meter._minInterval, meter._maxInterval) == timings
+
+
+def test_added_meter_is_reported_once(driver, make_meter, config_file, caplog):
+    meter = make_meter(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'})
+    path = config_file(SHELLY_CONNECTION=CONNECTION, PVINVERTER={'Phase': 'A'},
+                       **{'SHELLY_CONNECTION:garage': {'Host': '127.0.0.1:2'}})
+    names = ['']
+    with caplog.at_level(logging.WARNING):
+        for _ in range(3):
+            names = driver.reload_config(path, [meter], names)
+    assert names == ['', 'garage']
+    assert [record.getMessage() for record in caplog.records if 'added or removed' in record.getMessage()] == \
+        ['[SHELLY_CONNECTION:garage] added or removed, restart the service to apply it']
+
+
+def test_watcher_reloads_once_per_change(driver, tmp_path):
+    path = tmp_path / 'config.ini'
+    path.write_text('[DEFAULT]\n')
+    reloads = []
+    watcher = driver.ConfigWatcher(str(path), lambda: reloads.append(True))
+    # no Gio in the stubs: the modification time is checked every CONFIG_POLL_INTERVAL
+    assert watcher._poll() and watcher._settle is None
+
+    path.write_text('[DEFAULT]\nLog_Level = INFO\n')
+    os.utime(path, ns=(0, 1))
+    watcher._poll()
+    assert watcher._settle is not None
+    assert watcher._settled() is False
+    assert reloads == [True]
+    # an event with no change in the file does not reload it again
+    watcher._changed(None, None, None, None)
+    watcher._settled()
+    assert reloads == [True]
@@ -0,0 +1,39 @@
+import threading
+
+
+def test_keep_alive_connection_is_reused(driver, shelly):
+    server = shelly()
+    client = driver.ShellyRpcClient(server.host)
+    for _ in range(5):
+        assert 'a_act_power' in client.get('EM.GetStatus')
+    assert client.stats() == (5, 4, 1)
+
+
+def test_digest_challenge_is_answered_once(driver, shelly):
+    server = shelly('--password', 'secret')
+    client = driver.ShellyRpcClient(server.host, password='secret')
+    assert 'a_act_power' in client.get('EM.GetStatus')
+    assert server.RequestHandlerClass.challenges == 1
+
+    # the PollScheduler workers and the device thread share the nonce of the first challenge
+    def worker():
+        for _ in range(3):
+            client.get('EMData.GetStatus')
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.RequestHandlerClass.challenges == 1
+
+
+def test_wrong_password_fails(driver, shelly):
+    server = shelly('--password', 'secret')
+    client = driver.ShellyRpcClient(server.host, password='wrong')
+    try:
+        client.get('EM.GetStatus')
+    except OSError:
+        pass
+    else:
+        raise AssertionError('accepted a wrong password')
+    assert client.lastStatusCode == 401
@@ -0,0 +1,68 @@
+import harness
+import pytest
+
+
+def test_roles_and_meters_get_their_own_bus_connection(driver, role_paths):
+    config = harness.load_config(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0'},
+                                 PVINVERTER={'Phase': 'A'}, GRID={'Phase': 'B'}, GENSET={'Phase': 'C'},
+                                 **{'SHELLY_CONNECTION:garage': {'Host': '127.0.0.1:2', 'History': '0'},
+                                    'GRID:garage': {'Phase': 'A', 'Deviceinstance': '50', 'CustomName': 'Garage'}})
+    meters = [driver.ShellyPro3EM(config, paths=role_paths, name=name) for name in driver.meter_names(config)]
+    roles = [role for meter in meters for role in meter.roles]
+    assert len(roles) == 4
+    assert len(set(id(role._bus) for role in roles)) == 4
+    for role in roles:
+        assert role._dbusservice._bus is role._bus
+        assert '/Ac/Power' in role._bus.paths
+
+    roles[0].unregister()
+    assert not roles[0]._bus.paths
+    for meter in meters:
+        meter._pollStop.set()
+
+
+@pytest.mark.parametrize('environment, bus', [({}, 'SystemBus'), ({'DBUS_SESSION_BUS_ADDRESS': 'unix:path=/tmp/bus'}, 'SessionBus')])
+def test_dbus_connection_is_private(driver, monkeypatch, environment, bus):
+    monkeypatch.delenv('DBUS_SESSION_BUS_ADDRESS', raising=False)
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    opened = []
+    for name in ('SystemBus', 'SessionBus'):
+        monkeypatch.setattr(driver.dbus, name, lambda private=False, name=name: opened.append((name, private)))
+    driver.dbus_connection()
+    assert opened == [(bus, True)]
+
+
+def test_phase_off_is_not_case_sensitive(driver):
+    config = harness.load_config(PVINVERTER={'Phase': 'off'}, GRID={'Phase': 'Off'}, GENSET={'Phase': 'b'})
+    assert [role for role, _ in driver.enabled_roles(config)] == ['GENSET']
+
+
+def test_device_request_leaves_the_poll_state_alone(make_meter):
+    # Sys.GetConfig runs in the device thread, the connection state belongs to the poll
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'})
+    meter._connected = 1
+    assert meter._getShellyGetConfig() is None
+    assert meter._connected == 1
+    assert meter._getShellyData() is None
+    assert meter._connected == 0
+
+
+def test_payloads_are_dumped_once_per_failure_streak(make_meter, monkeypatch):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '5'})
+    outcomes = [(None, ValueError('invalid JSON'))] * 3 + [({'a_act_power': 1.0}, None), (None, ValueError('invalid JSON'))]
+    monkeypatch.setattr(meter, '_callShelly', lambda method, **params: outcomes.pop(0))
+    dumps = []
+    monkeypatch.setattr(meter, 'dumpPayloads', dumps.append)
+    for _ in range(3):
+        assert meter._getShellyData() is None
+    assert len(dumps) == 1
+    assert meter._getShellyData() == {'a_act_power': 1.0}
+    assert meter._getShellyData() is None
+    assert len(dumps) == 2
+
+
+def test_payloads_are_not_dumped_into_the_repository(make_meter, tmp_path):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '5'})
+    meter._getShellyData()
+    assert [path.name for path in tmp_path.iterdir()] == ['payloads_127_0_0_1_1.log']
@@ -0,0 +1,82 @@
+import socketserver
+import struct
+import threading
+
+import pytest
+
+
+def register_words(value):
+    # float32 with the low word first, as in the register tables of the device
+    data = struct.pack('>f', value)
+    return data[2:] + data[:2]
+
+
+def test_registers_are_decoded_to_the_rpc_units(driver):
+    client = driver.ShellyModbusClient('127.0.0.1')
+    first, count, _ = driver.MODBUS_BLOCKS['EMData.GetStatus']
+    block = bytearray(count * 2)
+    # phase A total active energy (31170) and phase C total returned energy (31214), in kWh
+    block[0:4] = register_words(123.45678)
+    block[(31214 - first) * 2:(31214 - first) * 2 + 4] = register_words(0.5)
+    client._readInputRegisters = lambda first, count: bytes(block)
+    client._sock = object()
+    data = client.get('EMData.GetStatus')
+    assert data['a_total_act_energy'] == pytest.approx(123456.78, rel=1e-6)
+    assert data['c_total_act_ret_energy'] == pytest.approx(500.0)
+
+
+# Input registers of the Shelly Pro 3EM, as listed in its documentation
+# (https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/EM#modbus-registers and
+# https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/EMData#modbus-registers): float32, energy in kWh
+REGISTERS = {
+    31020: ('a_voltage', 230.1), 31022: ('a_current', 3.12), 31024: ('a_act_power', 717.6),
+    31026: ('a_aprt_power', 720.0), 31028: ('a_pf', 0.99),
+    31040: ('b_voltage', 231.4), 31042: ('b_current', 0.5), 31044: ('b_act_power', -115.2),
+    31046: ('b_aprt_power', 116.0), 31048: ('b_pf', -0.98),
+    31060: ('c_voltage', 229.8), 31062: ('c_current', 0.0), 31064: ('c_act_power', 0.0),
+    31066: ('c_aprt_power', 0.0), 31068: ('c_pf', 1.0),
+    31170: ('a_total_act_energy', 123.45678), 31174: ('a_total_act_ret_energy', 2.34567),
+    31190: ('b_total_act_energy', 0.0985), 31194: ('b_total_act_ret_energy', 45.6789),
+    31210: ('c_total_act_energy', 0.0), 31214: ('c_total_act_ret_energy', 0.00125),
+}
+
+
+class RegisterHandler(socketserver.BaseRequestHandler):
+    # 'read input registers' (function 4) answered from REGISTERS, 0 where nothing is listed
+    def handle(self):
+        memory = {}
+        for address, (_, value) in REGISTERS.items():
+            words = register_words(value)
+            memory[address], memory[address + 1] = words[:2], words[2:]
+        while True:
+            request = self.request.recv(12)
+            if len(request) < 12:
+                return
+            transaction, _, _, unit, function, first, count = struct.unpack('>HHHBBHH', request)
+            assert function == 4
+            block = b''.join(memory.get(address, b'\0\0') for address in range(first, first + count))
+            self.request.sendall(struct.pack('>HHHBBB', transaction, 0, len(block) + 3, unit, function, len(block)) + block)
+
+
+@pytest.fixture
+def modbus_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RegisterHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_modbus_reads_the_documented_registers(driver, modbus_server):
+    client = driver.ShellyModbusClient('127.0.0.1', port=modbus_server.server_address[1])
+    em = client.get('EM.GetStatus')
+    emdata = client.get('EMData.GetStatus')
+    client.close()
+    assert em['b_act_power'] == pytest.approx(-115.2)
+    assert emdata['c_total_act_ret_energy'] == pytest.approx(1.25)
+    for address, (key, value) in REGISTERS.items():
+        if address < 31170:
+            assert em[key] == pytest.approx(value, rel=1e-6, abs=1e-3), key
+        else:
+            assert emdata[key] == pytest.approx(value * 1000, rel=1e-6, abs=1e-3), key
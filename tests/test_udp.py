@@ -0,0 +1,65 @@
+import json
+import socket
+
+import harness
+import pytest
+
+VALUES = [230.1, 3.12, 717.6] * 3 + [123456.78, 2345.67] * 3
+
+
+def datagram(payload):
+    return ('shellypro3em-aabbccddeeff 1 1700000000.123 1|P3EM %s' % payload).encode()
+
+
+@pytest.fixture
+def udp_meter(make_meter, free_port):
+    return make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'Ingest': 'udp', 'UdpPort': str(free_port(socket.SOCK_DGRAM)),
+                                         'History': '0', 'PayloadBuffer': '0'})
+
+
+def test_valid_datagram(udp_meter):
+    meter_data, energy_data = udp_meter._parseDatagram(datagram(json.dumps([1, 1] + VALUES)))
+    assert meter_data['a_act_power'] == 717.6 and energy_data['c_total_act_ret_energy'] == 2345.67
+
+
+def test_missing_value_is_null(udp_meter):
+    meter_data, _ = udp_meter._parseDatagram(datagram(json.dumps([1, 1, None] + VALUES[1:])))
+    assert meter_data['a_voltage'] is None
+
+
+@pytest.mark.parametrize('payload', [
+    '{"a": 1}', '"text"', '42', 'null', '[1, 2]', 'not json',
+    json.dumps([1, 1, 'x'] + VALUES[1:]),
+    json.dumps([1, 1, True] + VALUES[1:]),
+    json.dumps([1, 1, {}] + VALUES[1:]),
+    json.dumps([None, 1] + VALUES),
+    json.dumps([1, 'x'] + VALUES),
+])
+def test_invalid_datagram_is_counted_and_dropped(udp_meter, payload):
+    assert udp_meter._parseDatagram(datagram(payload)) is None
+    assert udp_meter._udpReceived == 0
+
+
+def test_watch_survives_any_datagram(udp_meter):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    port = udp_meter._udpSocket.getsockname()[1]
+    for payload in ('{"a": 1}', json.dumps([1, 1, 'x'] + VALUES[1:]), json.dumps([1, 1] + VALUES)):
+        sender.sendto(datagram(payload), ('127.0.0.1', port))
+        assert udp_meter._udpReadable(udp_meter._udpSocket.fileno(), None) is True
+    assert udp_meter._pushActive and udp_meter._udpReceived == 1
+
+
+def test_udp_port_is_not_shared(make_meter, free_port):
+    port = str(free_port(socket.SOCK_DGRAM))
+    make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'Ingest': 'udp', 'UdpPort': port, 'History': '0'})
+    with pytest.raises(OSError):
+        make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:2', 'Ingest': 'udp', 'UdpPort': port, 'History': '0'})
+
+
+def test_same_udp_port_for_two_meters_is_refused(driver):
+    config = harness.load_config(SHELLY_CONNECTION={'Host': '10.0.0.5', 'Ingest': 'udp'},
+                                 **{'SHELLY_CONNECTION:garage': {'Host': '10.0.0.6', 'Ingest': 'UDP'}})
+    with pytest.raises(ValueError, match='5600'):
+        driver.check_udp_ports(config, driver.meter_names(config))
+    config['SHELLY_CONNECTION:garage']['UdpPort'] = '5601'
+    driver.check_udp_ports(config, driver.meter_names(config))
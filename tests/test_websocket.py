@@ -0,0 +1,157 @@
+import socket
+
+
+class ScriptedWebSocket:
+    """Stands for ShellyWebSocket in _websocketSession: recv() returns the frames given, then the connection drops."""
+    host = 'scripted'
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.calls = []
+        self.challenges = []
+
+    def call(self, method, params=None):
+        self.calls.append(method)
+        return len(self.calls)
+
+    def authenticate(self, error):
+        self.challenges.append(error)
+
+    def recv(self):
+        if not self.frames:
+            raise ConnectionError('end of the script')
+        return self.frames.pop(0)
+
+
+EM = {'a_voltage': 230.0, 'a_current': 1.0, 'a_act_power': 230.0}
+EMDATA = {'a_total_act_energy': 1000.0, 'a_total_act_ret_energy': 10.0}
+
+
+def session(meter, frames):
+    samples = []
+    meter._queueSample = samples.append
+    ws = ScriptedWebSocket(frames)
+    try:
+        meter._websocketSession(ws)
+    except ConnectionError:
+        pass
+    return ws, [(sample[3], sample[4]) for sample in samples]
+
+
+def test_first_status_then_notify_deltas_are_merged(make_meter):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'})
+    ws, samples = session(meter, [
+        {'id': 1, 'result': {'em:0': EM, 'emdata:0': EMDATA, 'sys': {}}},
+        {'method': 'NotifyStatus', 'params': {'ts': 1, 'em:0': {'a_act_power': 250.0}}},
+        {'method': 'NotifyStatus', 'params': {'ts': 2, 'emdata:0': {'a_total_act_energy': 1000.5}}},
+        {'method': 'NotifyStatus', 'params': {'ts': 3, 'sys': {'uptime': 10}}},
+    ])
+    assert ws.calls == ['Shelly.GetStatus']
+    assert samples == [
+        (EM, EMDATA),
+        (dict(EM, a_act_power=250.0), EMDATA),
+        (dict(EM, a_act_power=250.0), dict(EMDATA, a_total_act_energy=1000.5)),
+    ]
+    assert meter._pushActive
+
+
+def test_nothing_is_pushed_before_power_and_energy_are_known(make_meter):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'})
+    _, samples = session(meter, [
+        {'id': 1, 'result': {'em:0': EM}},
+        {'method': 'NotifyStatus', 'params': {'em:0': {'a_act_power': 250.0}}},
+    ])
+    assert samples == []
+    assert not meter._pushActive
+
+
+def test_401_authenticates_and_repeats_the_request(make_meter):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'})
+    ws, samples = session(meter, [
+        {'id': 1, 'error': {'code': 401, 'message': '{"auth_type":"digest","nonce":1,"realm":"x","algorithm":"SHA-256"}'}},
+        {'id': 2, 'result': {'em:0': EM, 'emdata:0': EMDATA}},
+    ])
+    assert ws.calls == ['Shelly.GetStatus', 'Shelly.GetStatus']
+    assert len(ws.challenges) == 1
+    assert samples == [(EM, EMDATA)]
+
+
+def test_frames_that_are_not_objects_are_skipped(make_meter):
+    meter = make_meter(SHELLY_CONNECTION={'Host': '127.0.0.1:1', 'History': '0', 'PayloadBuffer': '0'})
+    _, samples = session(meter, [
+        [1, 2],
+        'text',
+        {'id': 1, 'result': []},
+        {'method': 'NotifyStatus', 'params': 'x'},
+        {'method': 'NotifyStatus', 'params': {'em:0': [1], 'emdata:0': None}},
+        {'method': 'NotifyStatus', 'params': {'em:0': EM, 'emdata:0': EMDATA}},
+    ])
+    assert samples == [(EM, EMDATA)]
+
+
+def test_pushed_readings_from_the_stand_in(make_meter, shelly, wait_for):
+    server = shelly('--notify-interval', '0.05', '--energy-every', '3')
+    meter = make_meter(SHELLY_CONNECTION={'Host': server.host, 'Ingest': 'websocket', 'History': '0', 'PayloadBuffer': '0'})
+    samples = []
+    meter._queueSample = samples.append
+    wait_for(lambda: len(samples) >= 10)
+    assert meter._pushActive
+    for _, _, connected, meter_data, energy_data in samples:
+        assert connected == 1
+        assert 'a_act_power' in meter_data and 'c_total_act_ret_energy' in energy_data
+
+
+def test_401_with_the_stand_in(make_meter, shelly, wait_for):
+    server = shelly('--password', 'secret', '--notify-interval', '0.05')
+    meter = make_meter(SHELLY_CONNECTION={'Host': server.host, 'Ingest': 'websocket', 'Password': 'secret',
+                                          'History': '0', 'PayloadBuffer': '0'})
+    wait_for(lambda: meter._pushActive)
+
+
+def test_polling_takes_over_when_the_socket_drops(make_meter, shelly, wait_for):
+    server = shelly('--notify-interval', '0.05')
+    meter = make_meter(SHELLY_CONNECTION={'Host': server.host, 'Ingest': 'websocket', 'History': '0', 'PayloadBuffer': '0'})
+    wait_for(lambda: meter._pushActive)
+    # pushing: poll() sends nothing
+    requests = meter.stats.requests
+    meter.poll()
+    assert meter.stats.requests == requests
+
+    for sock in list(server.RequestHandlerClass.websockets):
+        sock.shutdown(socket.SHUT_RDWR)
+    wait_for(lambda: not meter._pushActive)
+    samples = []
+    meter._queueSample = samples.append
+    meter.poll()
+    assert meter.stats.requests > requests
+    (_, _, connected, meter_data, energy_data), = samples
+    assert connected == 1 and 'a_act_power' in meter_data and 'a_total_act_energy' in energy_data
+
+
+def test_timeout_inside_a_frame_keeps_the_stream_in_step(driver):
+    ours, device = socket.socketpair()
+    ours.settimeout(0.1)
+    ws = driver.ShellyWebSocket('127.0.0.1')
+    ws._sock = ours
+    message = b'{"method": "NotifyStatus", "params": {"em:0": {"a_act_power": 1.5}}}'
+    # header, then silence, then the payload
+    device.sendall(bytes([0x81, len(message)]) + message[:10])
+    try:
+        ws.recv()
+    except socket.timeout:
+        pass
+    else:
+        raise AssertionError('a frame was returned before its payload')
+    device.sendall(message[10:])
+    assert ws.recv()['params']['em:0']['a_act_power'] == 1.5
+
+    # a message in two frames, with a timeout between them
+    device.sendall(bytes([0x01, 10]) + message[:10])
+    try:
+        ws.recv()
+    except socket.timeout:
+        pass
+    device.sendall(bytes([0x80, len(message) - 10]) + message[10:])
+    assert ws.recv()['method'] == 'NotifyStatus'
+    ours.close()
+    device.close()